@@ -10,8 +10,14 @@ from mycroft.util.log import LOG
 import requests
 import urllib.parse
 import json
+from threading import Thread
+from time import perf_counter
 from datetime import datetime, timedelta, date
-from .mysql_client import mysql_client
+from calendar import monthrange
+from .config import SE_SITES, SE_SCHEDULE, SE_HISTORY_DEPTH, SQL_RETENTION
+from .metrics import registry as metrics, timed
+from .scheduler import poll_scheduler
+from .site_monitor import site_monitor
 
 
 class SolaredgePvMonitoring(MycroftSkill):
@@ -19,10 +25,13 @@ class SolaredgePvMonitoring(MycroftSkill):
         MycroftSkill.__init__(self)
 
     def initialize(self):
+        load_start = perf_counter()
         self.siteID = self.settings.get('siteID', None)
         self.apiKey = self.settings.get('apiKey', None)
         if not self.siteID or not self.apiKey:
             self.speak_dialog("credentials_missing")
+        self.monitor = site_monitor(self.monitored_sites(),
+                                    default_timezone())
         self.settings_change_callback = self.backend_change
 
         # database stuff
@@ -30,21 +39,17 @@ class SolaredgePvMonitoring(MycroftSkill):
         self.use_ssl = self.settings.get("use_ssl", False)
         self.db_lang = self.settings.get("db_lang", None)
         self.db_name = self.settings.get("db_name", None)
-        # automated check interval
-        self.check_intervall = 900  # seconds
-
-        if self.use_storage:
-            if not self.db_lang or not self.db_name:
-                self.speak_dialog('database_credentials_missing')
-            else:
-                self.db_init()
-                self.schedule_repeating_event(self.handle_solardata_storage,
-                                              None,
-                                              self.check_intervall,
-                                              name="SolarStorage")
-                self.recent_checktime = now_local()
-                LOG.info("Next solar data check: {}".format((now_local(
-                )+timedelta(seconds=self.check_intervall)).strftime("%Y-%m-%d %H:%M:%S")))
+        self.db_ready = False
+        self.recent_checktime = {}
+        # automated checks, paused at night at the panels' location
+        coordinate = (self.location or {}).get("coordinate", {})
+        self.scheduler = poll_scheduler(
+            SE_SCHEDULE["interval"], SE_SCHEDULE["settle"],
+            SE_SCHEDULE["twilight"],
+            SE_SCHEDULE["latitude"] if SE_SCHEDULE["latitude"] is not None
+            else coordinate.get("latitude", None),
+            SE_SCHEDULE["longitude"] if SE_SCHEDULE["longitude"] is not None
+            else coordinate.get("longitude", None))
 
         # SE Aggregation granularity
         self.SE_timeUnits = self.translate_namedvalues('granularity')
@@ -55,6 +60,22 @@ class SolaredgePvMonitoring(MycroftSkill):
         for item in self.subject.keys():
             self.register_vocabulary(item, 'subject')
 
+        # the database is connected in the background, intents are
+        # registered right after initialize and don't wait for it
+        if self.use_storage:
+            if not self.db_lang or not self.db_name:
+                self.speak_dialog('database_credentials_missing')
+            else:
+                self.start_storage()
+        LOG.info("Skill initialized in {:.0f} ms".format(
+            (perf_counter() - load_start) * 1000))
+
+    def monitored_sites(self):
+        ''' Output: SE_SITES or the unnamed site of the skill settings '''
+        if SE_SITES:
+            return SE_SITES
+        return [{"name": None, "siteID": self.siteID, "apiKey": self.apiKey}]
+
     def backend_change(self):
         siteID = self.settings.get('siteID', None)
         apiKey = self.settings.get('apiKey', None)
@@ -67,6 +88,11 @@ class SolaredgePvMonitoring(MycroftSkill):
             self.speak_dialog("credentials_changed")
             self.siteID = siteID
             self.apiKey = apiKey
+            self.monitor.close()
+            self.monitor = site_monitor(self.monitored_sites(),
+                                        default_timezone())
+            if self.db_ready:
+                self.start_storage()
         if (db_name != self.db_name or db_lang != self.db_lang) and use_storage:
             self.speak_dialog("database_credentials_changed")
             self.db_name = db_name
@@ -86,64 +112,184 @@ class SolaredgePvMonitoring(MycroftSkill):
             if (not db_name or not db_lang) and use_storage:
                 self.speak_dialog('database_credentials_missing')
             elif use_storage or use_ssl:
-                self.db_init()
-                self.schedule_repeating_event(self.handle_solardata_storage,
-                                              None,
-                                              self.check_intervall,
-                                              name="SolarStorage")
-                self.recent_checktime = now_local()
-                LOG.info("Next solar data check: {}".format((now_local(
-                )+timedelta(seconds=self.check_intervall)).strftime("%Y-%m-%d %H:%M:%S")))
+                self.start_storage()
+
+    def start_storage(self):
+        Thread(target=self.db_init, daemon=True).start()
 
     def db_init(self):
-        self.mysql_client = mysql_client(language=self.db_lang)
         # this case will always return False the first time since the key doesn't exist
         # this way i can ensure a one time catch of the historical data
         hist_data = self.settings.get('historical_data', False)
-        self.mysql_client.set_timezone(default_timezone())
 
-        connection = self.mysql_client.create_connection(self.db_name,
-                                                         self.use_ssl)
-        if connection != 0:
+        connections = self.monitor.connect_storage(self.db_lang, self.db_name,
+                                                   self.use_ssl)
+        timings = self.monitor.storage_timings
+        LOG.info("Storage imported in {:.0f} ms, connected in {:.0f} ms"
+                 .format(timings["import"] * 1000, timings["connect"] * 1000))
+        metrics.gauge("solaredge_storage_import_seconds", timings["import"])
+        metrics.gauge("solaredge_storage_connect_seconds",
+                      timings["connect"])
+        errors = [connection for connection in connections.values()
+                  if connection != 0]
+        self.db_ready = not errors
+        if errors:
             self.speak_dialog('database_connection_failed',
-                              data={"errormsg": connection})
+                              data={"errormsg": errors[0]})
         else:
             self.speak_dialog('database_connected')
+            self.restore_checktime()
+            self.schedule_poll()
+            if SQL_RETENTION["enabled"]:
+                self.schedule_retention()
 
             if not hist_data:
                 self.speak_dialog('historical_data_load')
-                try:
-                    loaded = self.mysql_client.retrieve_historical_data()
-                    if loaded:
-                        self.speak_dialog('historical_data_success')
-                        self.settings['historical_data'] = True
-                except Exception as e:
-                    error = str(e)
-                    self.speak_dialog('historical_data_failed',
-                                      data={"error": error})
+                # runs in the background, resumes from the last checkpoint
+                Thread(target=self.historical_backfill, daemon=True).start()
+            else:
+                # holes left by downtime, crashes or failed checks
+                Thread(target=self.repair_history, daemon=True).start()
+
+    def restore_checktime(self):
+        ''' Last stored interval per site. It is persisted, so the first
+            poll after downtime catches up from there in one request.
+        '''
+        now = now_local()
+        saved = self.settings.get("recent_checktime", {})
+        depth = SE_HISTORY_DEPTH.get("QUARTER_OF_AN_HOUR", None)
+        self.recent_checktime = {}
+        for site in self.monitor.storage:
+            checktime = saved.get(site or "", None)
+            if checktime:
+                checktime = datetime.strptime(checktime, "%Y-%m-%d %H:%M:%S")\
+                    .replace(tzinfo=now.tzinfo)
+            else:
+                checktime = self.scheduler.floor(now)
+            if depth:
+                checktime = max(checktime, now - timedelta(days=depth))
+            self.recent_checktime[site] = checktime
+
+    def schedule_poll(self):
+        when = self.scheduler.next_poll(now_local(),
+                                        self.monitor.requests_left())
+        self.cancel_scheduled_event("SolarStorage")
+        self.schedule_event(self.handle_solardata_storage, when,
+                            name="SolarStorage")
+        LOG.info("Next solar data check: {}".format(
+            when.strftime("%Y-%m-%d %H:%M:%S")))
 
+    def schedule_retention(self):
+        now = now_local()
+        when = now.replace(hour=SQL_RETENTION["off_peak"][0], minute=0,
+                           second=0, microsecond=0)
+        if when <= now:
+            when += timedelta(days=1)
+        self.cancel_scheduled_event("SolarRetention")
+        self.schedule_repeating_event(self.handle_retention, when,
+                                      24 * 3600, name="SolarRetention")
+
+    def handle_retention(self):
+        if not self.use_storage or not self.db_ready:
+            return
+        for site, report in self.monitor.apply_retention().items():
+            if isinstance(report, Exception):
+                LOG.error("Retention of site {} failed: {}".format(
+                    site or self.siteID, report))
+            else:
+                LOG.info("Retention of site {}: {} days compacted, {} rows "
+                         "deleted, {} hourly rows expired, {:.1f} MB "
+                         "reclaimed{}".format(
+                             site or self.siteID, report["days"],
+                             report["deleted"], report["expired"],
+                             report["reclaimed_bytes"] / 2**20,
+                             "" if report["complete"]
+                             else " (continued tomorrow)"))
+
+    def repair_history(self):
+        for site, report in self.monitor.repair_gaps().items():
+            if isinstance(report, Exception):
+                LOG.error("Gap repair of site {} failed: {}".format(
+                    site or self.siteID, report))
+            else:
+                LOG.info("Gap repair of site {}: {}".format(
+                    site or self.siteID, report))
+
+    def historical_backfill(self):
+        loaded = True
+        try:
+            for site, client in self.monitor.storage.items():
+                key = 'historical_checkpoints_' + site if site \
+                    else 'historical_checkpoints'
+                checkpoints = self.settings.get(key, {})
+                if checkpoints:
+                    LOG.info("Resuming historical data after {}".format(
+                        ', '.join(checkpoints.keys())))
+
+                def progress(window, endTime, done, total,
+                             key=key, checkpoints=checkpoints):
+                    checkpoints[window] = endTime
+                    self.settings[key] = checkpoints
+                    LOG.info("Historical data {}/{}: {} stored".format(
+                        done, total, window))
+
+                loaded = client.retrieve_historical_data(checkpoints,
+                                                         progress) and loaded
+            if loaded:
+                self.speak_dialog('historical_data_success')
+                self.settings['historical_data'] = True
+        except Exception as e:
+            error = str(e)
+            self.speak_dialog('historical_data_failed',
+                              data={"error": error})
+
+    @timed("handle_solardata_storage")
     def handle_solardata_storage(self):
+        if not self.use_storage or not self.db_ready:
+            return
+        cycle_start = perf_counter()
         # file_db = ["csv", "json", "xlsx"]
         apis_check = ["energyDetails"]  # "powerDetails",
 
+        now = now_local()
+        self.schedule_poll()
+        since = {site: checktime.strftime("%Y-%m-%d %H:%M:%S")
+                 for site, checktime in self.recent_checktime.items()}
         params = {"slice": "day",
                   "timeUnit": "QUARTER_OF_AN_HOUR",
-                  "startTime": self.recent_checktime.strftime("%Y-%m-%d %H:%M:%S"),
-                  "endTime": now_local().strftime("%Y-%m-%d %H:%M:%S")}
+                  "checkTime": True}
 
+        failed = set()
         for api in apis_check:
-            data = \
-                self.mysql_client.get_api_response(api,
-                                                   **params)
-
-            self.mysql_client.to_sql(data, api, checkTime=True)
+            results = self.monitor.poll(since,
+                                        now.strftime("%Y-%m-%d %H:%M:%S"),
+                                        api=api, **params)
+            for site, result in results.items():
+                if isinstance(result, Exception):
+                    LOG.error("Solar data of site {} not stored: {}".format(
+                        site or self.siteID, result))
+                    failed.add(site)
 
-        self.recent_checktime = now_local()
+        # failed sites catch up with the next check, the others continue
+        # with the interval still running (its last row wasn't stored)
+        for site in self.recent_checktime:
+            if site not in failed:
+                self.recent_checktime[site] = self.scheduler.floor(now)
+        self.settings["recent_checktime"] = {
+            site or "": checktime.strftime("%Y-%m-%d %H:%M:%S")
+            for site, checktime in self.recent_checktime.items()}
         LOG.info("Data dumped")
-        LOG.info("Next solar data check: {}".format((now_local(
-        )+timedelta(seconds=self.check_intervall)).strftime("%Y-%m-%d %H:%M:%S")))
+        if metrics.enabled:
+            metrics.gauge("solaredge_storage_cycle_seconds",
+                          perf_counter() - cycle_start)
+            try:
+                metrics.write()
+            except OSError as e:
+                LOG.warning("Metrics not written: {}".format(e))
+            LOG.info("Metrics: {}".format(metrics.summary()))
 
     @intent_handler(IntentBuilder("power_currently").require("currently").one_of("consumption", "production", "from_grid").optionally("subject").build())
+    @timed("handle_power_currently")
     def handle_power_currently(self, message):
         '''
         Handles utterances like:
@@ -159,12 +305,11 @@ class SolaredgePvMonitoring(MycroftSkill):
                 json_code, dialog = tasks[item]
                 break
 
-        json_resp = self.mysql_client.get_api_response("currentPowerFlow",
-                                                       format=False)
-        value = json_resp["siteCurrentPowerFlow"][json_code]["currentPower"]
-        # if they sent kW
-        if json_resp["siteCurrentPowerFlow"]["unit"] == "kW":
-            value *= 1000
+        # summed over all monitored sites
+        value = self.monitor.current_power(json_code)
+        LOG.debug("api cache: {}".format(
+            {site: client.cache_stats
+             for site, client in self.monitor.api.items()}))
         self.speak_dialog(dialog, data={'value': value})
 
     @intent_handler(IntentBuilder("compare_power").require("compare")
@@ -174,6 +319,7 @@ class SolaredgePvMonitoring(MycroftSkill):
                             "selfconsumption")
                     .optionally("subject").optionally("granularity")
                     .optionally("split_connector").build())
+    @timed("handle_compare_energy")
     def handle_compare_energy(self, message):
         '''
         Usage limitation:
@@ -199,9 +345,6 @@ class SolaredgePvMonitoring(MycroftSkill):
         # get granularity (defaults to DAY -on SE end- if none is given)
         granularity = self.SE_timeUnits.get(
             message.data.get("granularity", None), "DAY")
-        dtmanipulation = {"DAY": ("00:00:00", "23:59:59"),
-                          "MONTH": ("01 00:00:00", "28 23:59:59"),
-                          "YEAR": ("01-01 00:00:00", "12-31 23:59:59")}
 
         # split utterance to get startTime and endTime (SE jargon)
         split_connector = message.data.get("split_connector", None)
@@ -217,9 +360,7 @@ class SolaredgePvMonitoring(MycroftSkill):
             utt_list.sort()
             LOG.info(utt_list)
             startTime = utt_list[0][0]
-            # has to be changed to the end of the timeframe, or the data is void
-            endTime = utt_list[1][0].replace(dtmanipulation[granularity][0],
-                                             dtmanipulation[granularity][1])
+            endTime = utt_list[1][0]
         else:
             # set the enddate to yesterday if only one date is given
             endTime = date.today() - timedelta(days=1)
@@ -242,26 +383,45 @@ class SolaredgePvMonitoring(MycroftSkill):
         else:
             subject_trans = "energy"
         API = API_code[subject_trans]
-        json_resp = self.mysql_client.get_api_response(API,
-                                                       meters=meter.upper(),
-                                                       timeUnit=granularity,
-                                                       startTime=startTime,
-                                                       endTime=endTime)
-
-        # list of time/value dicts
-        values = json_resp[API]["meters"][0]["values"]
-        # check for missing values or uncomplete data (no final value; eg calling for day data of today)
-        # leveraging dtmanipulation dict
-        for check in range(len(values)-1, 0, -1):
-            # date is always present
-            datum = values[check]["date"].replace(dtmanipulation[granularity][0],
-                                                  dtmanipulation[granularity][1])
-            if values[check].get("value", None) and \
-                    datetime.strptime(datum, "%Y-%m-%d %H:%M:%S") < now:
-                value2 = values[check]["value"]
-                break
 
-        value1 = values[0]["value"]
+        # compared are the period of startTime and the last complete
+        # period up to endTime
+        first = self.__period(granularity, datetime.strptime(
+            startTime, "%Y-%m-%d %H:%M:%S"))
+        last = self.__period(granularity, datetime.strptime(
+            endTime, "%Y-%m-%d %H:%M:%S"))
+        if last[1] >= now.replace(tzinfo=None, hour=0, minute=0, second=0,
+                                  microsecond=0):
+            last = self.__period(granularity, last[0] - timedelta(days=1))
+        if first[0] > last[0]:
+            # eg. "this month", no complete period to compare with yet
+            self.speak_dialog("compare_no_data", data={"time": req_time})
+            return
+
+        # summed over all sites, two lookups per period in the cumulative
+        # index if every day is stored
+        totals = None
+        if self.use_storage and self.db_ready and API == "energyDetails":
+            totals = self.monitor.period_totals(meter, [first, last])
+        if totals:
+            value1, value2 = totals
+        else:
+            values = self.monitor.period_values(
+                API, meter, granularity,
+                first[0].strftime("%Y-%m-%d %H:%M:%S"),
+                last[1].strftime("%Y-%m-%d 23:59:59"),
+                use_storage=self.use_storage and self.db_ready)
+            # the first period and the last one with a value
+            values = {item["date"]: item["value"] for item in values
+                      if item.get("value", None) is not None}
+            value1 = values.get(first[0].strftime("%Y-%m-%d %H:%M:%S"), None)
+            dates = [key for key in values
+                     if key <= last[0].strftime("%Y-%m-%d %H:%M:%S")]
+            value2 = values[max(dates)] if dates else None
+        if not value1 or value2 is None:
+            self.speak_dialog("compare_no_data", data={"time": req_time})
+            return
+
         LOG.info(value2)
         percent = (value2-value1)/value1*100
         LOG.info(percent)
@@ -273,6 +433,23 @@ class SolaredgePvMonitoring(MycroftSkill):
                                         "value": '{:.0f}'.format(abs(percent)),
                                         "tendency": tendency})
 
+    def __period(self, granularity, time):
+        ''' Output: (first, last) day of the DAY, WEEK, MONTH or YEAR
+                    containing time
+        '''
+        first = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        if granularity == "WEEK":
+            first -= timedelta(days=first.weekday())
+            return first, first + timedelta(days=6)
+        elif granularity == "MONTH":
+            first = first.replace(day=1)
+            return first, first.replace(
+                day=monthrange(first.year, first.month)[1])
+        elif granularity == "YEAR":
+            first = first.replace(month=1, day=1)
+            return first, first.replace(month=12, day=31)
+        return first, first
+
 
 def create_skill():
     return SolaredgePvMonitoring()
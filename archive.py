@@ -0,0 +1,138 @@
+import json
+import os
+from threading import Lock
+
+from .columnar import energy_columns, np
+
+
+class energy_archive(object):
+    ''' Memory-mapped columnar archive of one base table.
+        Every meter is a fixed-width float64 file on a regular time grid
+        (origin + slot * interval, missing samples are NaN), so the time
+        index is implicit: a date range maps to a slot range in O(1) and
+        is read as a zero-copy view of the mapped file. Writes land in
+        their slot, later corrections and repairs overwrite in place.
+    '''
+    def __init__(self, path, meters, interval=900):
+        self.path = os.path.expanduser(path)
+        self.meters = list(meters)
+        self.interval = interval
+        self.origin = None
+        self.rows = 0
+        self._maps = {}
+        self._lock = Lock()
+        os.makedirs(self.path, exist_ok=True)
+        meta = os.path.join(self.path, "meta.json")
+        if os.path.exists(meta):
+            with open(meta) as f:
+                meta = json.load(f)
+            if meta["meters"] == self.meters and \
+                    meta["interval"] == self.interval:
+                self.origin = meta["origin"]
+                self.rows = meta["rows"]
+
+    def __len__(self):
+        return self.rows
+
+    def write(self, rows):
+        ''' Input: energy_columns or rows [Time, value, ...] in meter order '''
+        if isinstance(rows, energy_columns):
+            times = rows.time.astype("datetime64[s]").astype(np.int64)
+            values = rows.values
+        else:
+            rows = [row for row in rows if row[0] is not None]
+            if not rows:
+                return
+            times = np.array([row[0] for row in rows],
+                             dtype="datetime64[s]").astype(np.int64)
+            values = np.array([[np.nan if value is None else value
+                                for value in row[1:]] for row in rows],
+                              dtype=np.float64)
+        if not len(times):
+            return
+
+        with self._lock:
+            first = int(times.min()) - int(times.min()) % self.interval
+            if self.origin is None:
+                self.origin = first
+            elif first < self.origin:
+                self.__prepend((self.origin - first) // self.interval)
+            slots = (times - self.origin) // self.interval
+            if slots.max() >= self.rows:
+                self.__grow(int(slots.max()) + 1)
+            for idx in range(len(self.meters)):
+                self.__map(self.meters[idx], "r+")[slots] = values[:, idx]
+            for mapped in self._maps.values():
+                mapped.flush()
+
+    def range(self, meter, startTime, endTime):
+        ''' Zero-copy view of one meter, startTime <= Time < endTime
+            (clipped to the archive)
+
+            Input: meter, startTime/endTime as datetime
+        '''
+        start, end = self.__slots(startTime, endTime)
+        return self.__map(meter, "r")[start:end]
+
+    def times(self, startTime, endTime):
+        ''' Output: datetime64 time index of range() '''
+        start, end = self.__slots(startTime, endTime)
+        return (np.arange(start, end, dtype=np.int64) * self.interval
+                + (self.origin or 0)).astype("datetime64[s]")
+
+    def sum(self, meter, startTime, endTime):
+        return float(np.nansum(self.range(meter, startTime, endTime)))
+
+    def __slots(self, startTime, endTime):
+        if self.origin is None:
+            return 0, 0
+        bounds = np.array([startTime, endTime], dtype="datetime64[s]") \
+            .astype(np.int64) - self.origin
+        # first slot at/after startTime, up to the last before endTime
+        start = -(-bounds[0] // self.interval)
+        end = -(-bounds[1] // self.interval)
+        return (int(min(max(start, 0), self.rows)),
+                int(min(max(end, 0), self.rows)))
+
+    def __file(self, meter):
+        return os.path.join(self.path, meter + ".f8")
+
+    def __map(self, meter, mode):
+        key = (meter, mode)
+        if key not in self._maps or len(self._maps[key]) != self.rows:
+            if not self.rows:
+                return np.zeros(0, dtype=np.float64)
+            self._maps[key] = np.memmap(self.__file(meter), dtype=np.float64,
+                                        mode=mode, shape=(self.rows,))
+        return self._maps[key]
+
+    def __grow(self, rows):
+        ''' Extends every file to rows slots, new slots are NaN '''
+        self._maps.clear()
+        missing = np.full(rows - self.rows, np.nan).tobytes()
+        for meter in self.meters:
+            with open(self.__file(meter), "ab") as f:
+                f.write(missing)
+        self.rows = rows
+        self.__save_meta()
+
+    def __prepend(self, slots):
+        ''' Moves the origin back (rewrites the files) '''
+        self._maps.clear()
+        missing = np.full(slots, np.nan).tobytes()
+        for meter in self.meters:
+            with open(self.__file(meter), "rb") as f:
+                data = f.read()
+            with open(self.__file(meter) + ".tmp", "wb") as f:
+                f.write(missing + data)
+            os.replace(self.__file(meter) + ".tmp", self.__file(meter))
+        self.origin -= slots * self.interval
+        self.rows += slots
+        self.__save_meta()
+
+    def __save_meta(self):
+        meta = os.path.join(self.path, "meta.json")
+        with open(meta + ".tmp", "w") as f:
+            json.dump({"meters": self.meters, "interval": self.interval,
+                       "origin": self.origin, "rows": self.rows}, f)
+        os.replace(meta + ".tmp", meta)
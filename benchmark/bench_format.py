@@ -0,0 +1,50 @@
+''' Micro-benchmark of mysql_client.__format and _slice_data
+    (row lists vs numpy columns)
+
+    python benchmark/bench_format.py
+'''
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from skill import load  # noqa: E402
+from payloads import energy_details  # noqa: E402
+
+load()
+from solaredge_skill import config  # noqa: E402
+from solaredge_skill.mysql_client import mysql_client  # noqa: E402
+
+CASES = [("DAY year", 365, "DAY"),
+         ("QUARTER_OF_AN_HOUR month", 31 * 96, "QUARTER_OF_AN_HOUR"),
+         ("QUARTER_OF_AN_HOUR year", 365 * 96, "QUARTER_OF_AN_HOUR")]
+
+
+def run(repeat=5):
+    client = mysql_client("mysql")
+    results = []
+    for name, rows, timeUnit in CASES:
+        payload = energy_details(rows, timeUnit)
+        for columnar in (False, True):
+            config.SE_COLUMNAR = columnar
+            sys.modules["solaredge_skill.mysql_client"].SE_COLUMNAR = columnar
+
+            def parse():
+                # parse, slice by day and materialize rows for the writer
+                data = client._mysql_client__format(payload, "energyDetails",
+                                                    slice="day")
+                for chunk in data:
+                    for row in chunk:
+                        pass
+
+            best = min(timeit.repeat(parse, number=1, repeat=repeat))
+            results.append({"case": name, "rows": rows,
+                            "columnar": columnar, "seconds": best,
+                            "rows_per_s": rows / best})
+    return results
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(json.dumps(result))
@@ -0,0 +1,77 @@
+''' Synthetic SolarEdge api payloads '''
+import math
+import random
+from datetime import datetime, timedelta
+
+METERS = ["Production", "FeedIn", "SelfConsumption", "Purchased",
+          "Consumption"]
+STEPS = {"QUARTER_OF_AN_HOUR": timedelta(minutes=15),
+         "HOUR": timedelta(hours=1),
+         "DAY": timedelta(days=1)}
+
+
+def period_start(time, timeUnit):
+    ''' Output: start of the api period holding time (weeks start monday,
+                months on the 1st, years on january 1st)
+    '''
+    if timeUnit in STEPS:
+        return time
+    day = time.replace(hour=0, minute=0, second=0, microsecond=0)
+    if timeUnit == "WEEK":
+        return day - timedelta(days=day.weekday())
+    elif timeUnit == "MONTH":
+        return day.replace(day=1)
+    return day.replace(month=1, day=1)
+
+
+def next_period(time, timeUnit):
+    ''' Output: start of the api period following the one starting at time '''
+    if timeUnit in STEPS:
+        return time + STEPS[timeUnit]
+    elif timeUnit == "WEEK":
+        return time + timedelta(days=7)
+    elif timeUnit == "MONTH":
+        return time.replace(year=time.year + time.month // 12,
+                            month=time.month % 12 + 1)
+    return time.replace(year=time.year + 1)
+
+
+def energy_details(rows, timeUnit="QUARTER_OF_AN_HOUR",
+                   start=datetime(2024, 1, 1), missing=0.01, seed=1):
+    ''' energyDetails/powerDetails payload with rows values per meter,
+        a fraction of missing values like the api sends at night.
+        WEEK/MONTH/YEAR rows are dated like the api, by the calendar
+        period they sum up.
+    '''
+    rnd = random.Random(seed)
+    dates = []
+    time = period_start(start, timeUnit)
+    for _ in range(rows):
+        dates.append(time.strftime("%Y-%m-%d %H:%M:%S"))
+        time = next_period(time, timeUnit)
+    meters = []
+    for meter in METERS:
+        values = []
+        for idx, date in enumerate(dates):
+            if rnd.random() < missing:
+                values.append({"date": date})
+            else:
+                sun = max(0.0, math.sin(idx % 96 / 96 * 2 * math.pi))
+                values.append({"date": date,
+                               "value": round(rnd.random() * 1000 * sun, 3)})
+        meters.append({"type": meter, "values": values})
+    return {"energyDetails": {"timeUnit": timeUnit, "unit": "Wh",
+                              "meters": meters}}
+
+
+def current_power_flow():
+    return {"siteCurrentPowerFlow": {
+        "updateRefreshRate": 3, "unit": "kW",
+        "GRID": {"status": "Active", "currentPower": 0.42},
+        "LOAD": {"status": "Active", "currentPower": 1.3},
+        "PV": {"status": "Active", "currentPower": 0.88}}}
+
+
+def data_period(start="2020-06-15", end=None):
+    end = end if end else datetime.now().strftime("%Y-%m-%d")
+    return {"dataPeriod": {"startDate": start, "endDate": end}}
@@ -0,0 +1,249 @@
+''' Benchmark suite of the storage and intent paths against a local stub
+    of the SolarEdge api (stub_server.py) and a disposable database.
+
+    python benchmark/run.py [--db sqlite|mysql] [--days 31] [--output file]
+
+    Every measurement is written as one JSON line (appended to --output,
+    default stdout) tagged with the git revision, so results of several
+    revisions can be collected in one file and compared.
+
+    The intents are measured without mycroft: power_currently is the
+    site_monitor.current_power call of handle_power_currently, compare is
+    the site_monitor.period_values call of handle_compare_energy (api only
+    and answered from the derivative tables) and its period_totals lookup
+    in the cumulative index.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from skill import load, ROOT  # noqa: E402
+from stub_server import stub_server  # noqa: E402
+
+load()
+from solaredge_skill import config  # noqa: E402
+
+DATABASE = "solaredge_benchmark"
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short",
+                                        "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL) \
+            .decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latency(func, repeat):
+    ''' Output: min/median/p95/max of func() in ms '''
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {"repeat": repeat,
+            "min_ms": samples[0],
+            "median_ms": statistics.median(samples),
+            "p95_ms": samples[min(len(samples) - 1,
+                                  int(round(0.95 * (len(samples) - 1))))],
+            "max_ms": samples[-1]}
+
+
+class suite(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.tmp = tempfile.mkdtemp(prefix="solaredge_benchmark_")
+        self.stub = stub_server(data_start=args.data_start,
+                                latency=args.latency / 1000.0).start()
+
+        # everything the skill reads from config is pointed at the stub
+        # and the disposable database before any client is created
+        config.SE_API["url"] = self.stub.url
+        config.SE_API["daily_quota"] = 10 ** 9
+        config.SE_API["retries"] = 0
+        config.SQL_SQLITE["path"] = self.tmp
+        config.SQL_SPOOL["path"] = os.path.join(self.tmp, "spool")
+        config.SQL_ARCHIVE["path"] = os.path.join(self.tmp, "archive")
+        config.SE_HISTORY_DEPTH["QUARTER_OF_AN_HOUR"] = args.days
+
+        from solaredge_skill.mysql_client import mysql_client
+        from solaredge_skill.site_monitor import site_monitor
+        self.mysql_client = mysql_client
+        self.site_monitor = site_monitor
+
+        self.end = datetime.now(tz=timezone.utc).replace(
+            tzinfo=None, minute=0, second=0, microsecond=0)
+        self.start = (self.end - timedelta(days=args.days)).replace(hour=0)
+
+    def record(self, benchmark, **values):
+        values.update({"benchmark": benchmark, "db": self.args.db})
+        self.results.append(values)
+
+    def storage(self, site="bench"):
+        client = self.mysql_client(self.args.db, site=site)
+        client.set_timezone(timezone.utc)
+        error = client.create_connection(DATABASE, False)
+        if error:
+            raise RuntimeError(error)
+        return client
+
+    def run(self):
+        try:
+            self.bench_format()
+            self.bench_ingest()
+            self.bench_backfill()
+            self.bench_from_sql()
+            self.bench_intents()
+        finally:
+            self.close()
+        return self.results
+
+    def bench_format(self):
+        import bench_format
+        for result in bench_format.run(self.args.repeat):
+            self.record("format", **result)
+
+    def bench_ingest(self):
+        client = self.storage()
+        requests = self.stub.requests
+        start = time.perf_counter()
+        rows = client.ingest("energyDetails",
+                             startTime=self.start.strftime(
+                                 "%Y-%m-%d %H:%M:%S"),
+                             endTime=self.end.strftime("%Y-%m-%d %H:%M:%S"))
+        seconds = time.perf_counter() - start
+        self.record("ingest", days=self.args.days, rows=rows,
+                    requests=self.stub.requests - requests,
+                    seconds=seconds, rows_per_s=rows / seconds)
+
+        # one storage cycle: last quarter-hours sliced by day with rollup
+        since = (self.end - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+        until = self.end.strftime("%Y-%m-%d %H:%M:%S")
+        self.record("storage_cycle", **latency(
+            lambda: client.ingest("energyDetails", slice="day",
+                                  checkTime=True, startTime=since,
+                                  endTime=until), self.args.repeat))
+        client.api.close()
+        client.close()
+
+    def bench_backfill(self):
+        client = self.storage(site="backfill")
+        requests = self.stub.requests
+        start = time.perf_counter()
+        client.retrieve_historical_data()
+        self.record("backfill", data_start=self.args.data_start,
+                    quarter_hour_days=self.args.days,
+                    requests=self.stub.requests - requests,
+                    seconds=time.perf_counter() - start)
+        client.api.close()
+        client.close()
+
+    def bench_from_sql(self):
+        client = self.storage()
+        for timespan in ["today", "day", "week", "month", "year"]:
+            self.record("from_sql", timespan=timespan, **latency(
+                lambda: client.from_sql("energy", self.end, timespan),
+                self.args.repeat))
+        self.record("aggregate", timespan="day,week,month,year", **latency(
+            lambda: client.aggregate("energy", self.end,
+                                     ["day", "week", "month", "year"]),
+            self.args.repeat))
+        client.api.close()
+        client.close()
+
+    def bench_intents(self):
+        site = {"name": "backfill", "siteID": "1", "apiKey": "bench"}
+        monitor = self.site_monitor([site], timezone.utc)
+        monitor.connect_storage(self.args.db, DATABASE, False)
+
+        def cold():
+            monitor.api["backfill"].invalidate_cache()
+            monitor.current_power("PV")
+
+        self.record("power_currently", cache="cold",
+                    **latency(cold, self.args.repeat))
+        self.record("power_currently", cache="warm",
+                    **latency(lambda: monitor.current_power("PV"),
+                              self.args.repeat))
+
+        # compare of the last days, backfill stored the day table
+        startTime = self.start.strftime("%Y-%m-%d %H:%M:%S")
+        endTime = (self.end.replace(hour=0) - timedelta(seconds=1)) \
+            .strftime("%Y-%m-%d %H:%M:%S")
+        for use_storage in (False, True):
+            self.record("compare", timeUnit="DAY", days=self.args.days,
+                        storage=use_storage,
+                        **latency(lambda: monitor.period_values(
+                            "energyDetails", "Production", "DAY",
+                            startTime, endTime, use_storage=use_storage),
+                            self.args.repeat))
+        # both compared periods from the cumulative index
+        periods = [(self.start, self.start),
+                   (self.end - timedelta(days=1), self.end - timedelta(days=1))]
+        self.record("compare", timeUnit="DAY", days=self.args.days,
+                    storage="cumulative",
+                    **latency(lambda: monitor.period_totals("Production",
+                                                            periods),
+                              self.args.repeat))
+        monitor.close()
+
+    def close(self):
+        self.stub.stop()
+        if self.args.db == "mysql":
+            from sqlalchemy_utils import database_exists, drop_database
+            url = "mysql+mysqldb://{}:{}@{}/{}".format(
+                config.SQL_CREDENTIALS["user"],
+                config.SQL_CREDENTIALS["password"],
+                config.SQL_CREDENTIALS["host"], DATABASE)
+            if database_exists(url):
+                drop_database(url)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--db", choices=["sqlite", "mysql"],
+                        default="sqlite",
+                        help="mysql uses SQL_CREDENTIALS and a disposable "
+                             "database " + DATABASE)
+    parser.add_argument("--days", type=int, default=31,
+                        help="quarter-hour days to ingest/backfill")
+    parser.add_argument("--data-start", default="2020-06-15",
+                        help="start of production served by dataPeriod")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="stub latency per request in ms")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None,
+                        help="file the JSON lines are appended to")
+    args = parser.parse_args()
+
+    meta = {"revision": revision(),
+            "timestamp": datetime.now(tz=timezone.utc).isoformat(),
+            "python": platform.python_version()}
+    results = suite(args).run()
+
+    out = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for result in results:
+            out.write(json.dumps(dict(meta, **result)) + "\n")
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
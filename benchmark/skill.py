@@ -0,0 +1,17 @@
+''' Loads the skill modules (config, mysql_client, ...) as package
+    "solaredge_skill" without running the mycroft entry point in
+    __init__.py, so they can be benchmarked outside of mycroft.
+'''
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load():
+    if "solaredge_skill" not in sys.modules:
+        package = types.ModuleType("solaredge_skill")
+        package.__path__ = [ROOT]
+        sys.modules["solaredge_skill"] = package
+    return sys.modules["solaredge_skill"]
@@ -0,0 +1,127 @@
+''' Local stub of the SolarEdge monitoring api.
+    Serves synthetic energyDetails/powerDetails (sized by the requested
+    range and timeUnit), currentPowerFlow, dataPeriod and the bulk
+    overview, optionally with an artificial latency per request. Errors
+    can be queued with fail() (client tests).
+'''
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from payloads import energy_details, current_power_flow, data_period, \
+    period_start, next_period
+
+
+class stub_server(object):
+
+    def __init__(self, data_start="2020-06-15", latency=0.0):
+        ''' Input: first day of production, latency per request in s '''
+        self.data_start = data_start
+        self.latency = latency
+        self.requests = 0
+        # queued error responses [(status, headers, body)]
+        self.failures = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0),
+                                          self.__handler())
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(self, status, times=1, retry_after=None, body=b""):
+        ''' Answers the next times requests with status (and Retry-After) '''
+        headers = {"Retry-After": str(retry_after)} \
+            if retry_after is not None else {}
+        with self._lock:
+            self.failures.extend([(status, headers, body)] * times)
+        return self
+
+    def respond(self, path, query):
+        ''' Output: json body of a request '''
+        parts = path.strip("/").split("/")
+        api = parts[-1]
+        if parts[0] == "sites" and api == "overview":
+            return {"sitesOverviews": {
+                "count": len(parts[1].split(",")),
+                "siteEnergyList": [
+                    {"siteId": int(site),
+                     "siteOverview": {"currentPower": {"power": 880.0}}}
+                    for site in parts[1].split(",")]}}
+        elif api == "dataPeriod":
+            return data_period(self.data_start)
+        elif api == "currentPowerFlow":
+            return current_power_flow()
+        elif api in ("energyDetails", "powerDetails"):
+            timeUnit = query.get("timeUnit", ["DAY"])[0]
+            startTime = datetime.strptime(query["startTime"][0],
+                                          "%Y-%m-%d %H:%M:%S")
+            endTime = datetime.strptime(query["endTime"][0],
+                                        "%Y-%m-%d %H:%M:%S")
+            # one row per (calendar) period the range touches
+            rows = 0
+            date = period_start(startTime, timeUnit)
+            while date <= endTime:
+                rows += 1
+                date = next_period(date, timeUnit)
+            body = energy_details(rows, timeUnit, start=startTime)
+            if api == "powerDetails":
+                body = {"powerDetails": body["energyDetails"]}
+            return body
+        return None
+
+    def __handler(self):
+        stub = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body in one segment (no delayed ACK stalls)
+            wbufsize = -1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                    failure = stub.failures.pop(0) if stub.failures \
+                        else None
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if failure:
+                    status, headers, body = failure
+                    self.send_response(status)
+                    for header, value in headers.items():
+                        self.send_header(header, value)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                url = urlparse(self.path)
+                body = stub.respond(url.path, parse_qs(url.query))
+                if body is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return handler
@@ -0,0 +1,89 @@
+from itertools import chain
+try:
+    import numpy as np
+except ImportError:
+    # optional, mysql_client falls back to row lists
+    np = None
+
+
+class energy_columns(object):
+    ''' Columnar representation of api meter data.
+        One datetime64 time column plus one float column per meter
+        (stored as a 2D array, columns in DB schema order). Slicing
+        returns views, rows are only built on iteration/indexing so it
+        can be handed to the SQL writer like a list of rows.
+    '''
+    def __init__(self, time, values):
+        self.time = time
+        self.values = values
+
+    @classmethod
+    def from_json(cls, meters, schema):
+        ''' Builds the columns from the api "meters" list.
+            Meters are consumed one by one, so a streamed iterator only
+            keeps one meter in memory.
+
+            Input: meters [{"type": .., "values": [{"date", "value"}]}],
+                   schema (value column names in order)
+        '''
+        meters = iter(meters)
+        first = next(meters, None)
+        if first is None:
+            return cls(np.array([], dtype="datetime64[s]"),
+                       np.zeros((0, len(schema)), dtype=np.float64))
+
+        # timestamps of the first meter are parsed in bulk
+        time = np.array([item["date"] for item in first["values"]],
+                        dtype="datetime64[s]")
+        values = np.zeros((len(time), len(schema)), dtype=np.float64)
+        for meter in chain([first], meters):
+            if meter["type"] not in schema:
+                continue
+            column = values[:, schema.index(meter["type"])]
+            items = meter["values"]
+            dates = np.array([item["date"] for item in items],
+                             dtype="datetime64[s]")
+            data = np.fromiter((item.get("value", np.nan) for item in items),
+                               dtype=np.float64, count=len(items))
+            # align on the time column, missing values become 0
+            if len(dates) == len(time) and (dates == time).all():
+                column[:] = data
+            else:
+                idx = np.searchsorted(time, dates)
+                found = idx < len(time)
+                found[found] = time[idx[found]] == dates[found]
+                column[idx[found]] = data[found]
+            np.nan_to_num(column, copy=False)
+        return cls(time, values)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return energy_columns(self.time[idx], self.values[idx])
+        return [self.time[idx].item()] + self.values[idx].tolist()
+
+    def __iter__(self):
+        # bulk conversion to python datetime/float
+        for time, values in zip(self.time.tolist(), self.values.tolist()):
+            yield [time] + values
+
+    def column(self, idx):
+        ''' Float array (view) of one meter '''
+        return self.values[:, idx]
+
+    def period_keys(self, slice):
+        ''' Integer period key of every row for day/week/month/year '''
+        if slice == "week":
+            # 1970-01-01 was a thursday, weeks start on monday
+            days = self.time.astype("datetime64[D]").astype(np.int64)
+            return (days + 3) // 7
+        unit = {"day": "D", "month": "M", "year": "Y"}[slice]
+        return self.time.astype("datetime64[{}]".format(unit)) \
+            .astype(np.int64)
+
+    def boundaries(self, slice):
+        ''' Row indices where a new day/week/month/year starts '''
+        keys = self.period_keys(slice)
+        return (np.flatnonzero(keys[1:] != keys[:-1]) + 1).tolist()
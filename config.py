@@ -1,7 +1,30 @@
-from sqlalchemy import Column, Integer, Float, DateTime
-
 SE_CREDENTIALS = {"apiKey": "XXXXXXXXX",
                   "siteID": "12345"}
+# multiple sites, every site gets its own table namespace (solar_<name>_...)
+# SE_SITES = [{"name": "home", "siteID": "12345", "apiKey": "XXXXXXXXX"},
+#             {"name": "barn", "siteID": "23456", "apiKey": "XXXXXXXXX"}]
+# if empty the site of the skill settings (or SE_CREDENTIALS) is monitored
+SE_SITES = []
+# SolarEdge monitoring api client
+SE_API = {"url": "https://monitoringapi.solaredge.com",
+          "timeout": (3.05, 30),  # connect / read timeout in seconds
+          "retries": 3,  # on 429 and 5xx
+          "backoff": 1,  # seconds, doubled on every retry
+          "daily_quota": 300,
+          "concurrency": 3,  # concurrent requests per site (api limit: 3)
+          # requests kept back for interactive calls (backfill is deferred)
+          "reserve": 50}
+# cached api responses: {api: (ttl, stale)} in seconds
+# fresh for ttl, afterwards served for another stale seconds
+# while being refreshed in the background
+SE_API_CACHE_TTL = {"currentPowerFlow": (60, 240),
+                    "overview": (60, 240)}
+# historical data loaded on first start in days, None = since installation
+SE_HISTORY_DEPTH = {"DAY": None, "QUARTER_OF_AN_HOUR": 30}
+# longest period the api serves in one request per timeUnit
+SE_API_WINDOW = {"QUARTER_OF_AN_HOUR": "month",
+                 "HOUR": "month",
+                 "DAY": "year"}
 SQL_CREDENTIALS = {"user": "user",
                    "password": "password",
                    "host": "ip:port"
@@ -9,16 +32,26 @@ SQL_CREDENTIALS = {"user": "user",
 SQL_SSL = {"CA": "/path/to/ca.pem",
            "CKEY": "/path/to/client-key.pem",
            "CCERT": "/path/to/client-cert.pem"}
+# local database (db_lang sqlite), stored as <path>/<db_name>.db
+SQL_SQLITE = {"path": "~/.local/share/mycroft/solaredge",
+              "pragmas": {"journal_mode": "WAL",
+                          "synchronous": "NORMAL",
+                          "temp_store": "MEMORY",
+                          "cache_size": -16000,  # KiB
+                          "mmap_size": 268435456,
+                          "busy_timeout": 5000}}  # ms
 #todo make table renaming possible
 #to add your own colums, append them after the last table entry
 
-SQL_DB_SCHEMAS = {"energy": {'id': Column(Integer, primary_key=True),
-                             'Time': Column(DateTime),
-                             'Production': Column(Float),
-                             'FeedIn': Column(Float),
-                             'SelfConsumption': Column(Float),
-                             'Purchased': Column(Float),
-                             'Consumption': Column(Float)}
+# column: (sqlalchemy type, Column keyword arguments), the columns are
+# built when the storage connects (SQLAlchemy is only imported then)
+SQL_DB_SCHEMAS = {"energy": {'id': ("Integer", {"primary_key": True}),
+                             'Time': ("DateTime", {"unique": True}),
+                             'Production': ("Float", {}),
+                             'FeedIn': ("Float", {}),
+                             'SelfConsumption': ("Float", {}),
+                             'Purchased': ("Float", {}),
+                             'Consumption': ("Float", {})}
                   }
 # The Solaredge-Api corresponding to a table
 SE_API_TABLE = {"energyDetails": "energy"}
@@ -30,7 +63,79 @@ SQL_TABLES_PREFIX = {"energy": "solar"}
 # if table is not mentioned it's a continuous table append
 SQL_SPLIT_TABLE_TIME = {}
 
+# one table with native RANGE partitioning on Time (MySQL) instead of split
+# tables, a partition per DAY, WEEK, MONTH or YEAR. Partitions are created
+# SQL_PARTITION_AHEAD periods in advance, split tables of the table are
+# moved into it. SQLite keeps it as one plain table.
+# SQL_PARTITION_TIME = {"energy": "month"}
+SQL_PARTITION_TIME = {}
+SQL_PARTITION_AHEAD = 3
+
 # derivative tables naming convention:
 # the derivative table (table inherits schema of basetable)
 # has to be named with the basename in front
 SQL_DERIVATIVE_TABLES = {"energy": ["day", "week", "month", "year"]}
+
+# cumulative index of the day table (<table>_cumulative): one row per stored
+# day with the totals of every meter up to and including that day, plus the
+# counters below (Days: number of stored days so far). The total of any date
+# range (day, month or year bounds) is the difference of two rows.
+SQL_CUMULATIVE_TABLES = {"energy": {"Days": ("Integer", {})}}
+
+# parse api data into numpy columns (if numpy is installed)
+SE_COLUMNAR = True
+
+# rows sent per executemany when writing to the database
+SQL_INSERT_BATCH_SIZE = 500
+
+# local write-ahead spool (spool.py): rows the database doesn't accept are
+# journaled in <path>/<db_name>[_<site>].spool and written back by a
+# background flusher every flush_interval seconds, oldest entries are
+# dropped beyond max_mb
+SQL_SPOOL = {"enabled": True,
+             "path": "~/.local/share/mycroft/solaredge/spool",
+             "max_mb": 50,
+             "flush_interval": 60,  # seconds
+             "batch": 50}  # entries read per round trip
+
+# retention of the quarter-hour rows: rows older than raw_days (at least
+# the quarter-hour history depth) are compacted into hourly rows
+# (<table>_hour) and missing day rows, then deleted. Hourly rows are kept
+# hour_days. Runs daily between the off_peak hours (local time), batch
+# rows per transaction.
+SQL_RETENTION = {"enabled": False,
+                 "raw_days": 90,
+                 "hour_days": 730,
+                 "off_peak": (1, 5),
+                 "batch": 5000}
+
+# quarter-hour samples of the last days kept in memory (ring_buffer.py),
+# rebuilt from the database on connect, 0 = off
+SQL_RECENT_DAYS = 7
+
+# memory-mapped columnar archive of the quarter-hour rows (archive.py,
+# needs numpy): one float64 file per meter on a fixed time grid in
+# <path>/<db_name>[_<site>]/<table>/, kept current with every write and
+# independent of the retention. Filled once from the database (batch rows
+# per fetch) if empty.
+SQL_ARCHIVE = {"enabled": True,
+               "path": "~/.local/share/mycroft/solaredge/archive",
+               "batch": 10000}
+
+# hot path instrumentation (metrics.py): latency histograms and counters,
+# written in the Prometheus text format (eg. for the node_exporter textfile
+# collector) and summarized in the log after every storage cycle
+SE_METRICS = {"enabled": False,
+              "file": "~/.local/share/mycroft/solaredge/metrics.prom",
+              "buckets": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                          1, 2.5, 5, 10, 30)}  # seconds
+
+# storage polls (scheduler.py): every interval seconds, aligned to the
+# interval boundaries plus settle seconds (until the api has the data).
+# Paused from sunset + twilight until sunrise - twilight at the panels,
+# coordinates None = location of the device
+SE_SCHEDULE = {"interval": 900,
+               "settle": 300,
+               "twilight": 1800,
+               "latitude": None,
+               "longitude": None}
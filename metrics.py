@@ -0,0 +1,169 @@
+import os
+from bisect import bisect_left
+from functools import wraps
+from inspect import isgeneratorfunction
+from threading import Lock
+from time import perf_counter
+
+from .config import SE_METRICS
+
+
+class metrics_registry(object):
+    ''' Process-wide latency histograms, counters and gauges.
+        While disabled every call returns right away, timed functions
+        only pay for one attribute check.
+    '''
+    def __init__(self, enabled=False, buckets=()):
+        self.enabled = enabled
+        self.buckets = tuple(sorted(buckets))
+        # {(name, labels): [bucket counts..., sum, count]}
+        self.histograms = {}
+        # {(name, labels): value}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = Lock()
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = \
+                    [0] * (len(self.buckets) + 1) + [0.0, 0]
+            histogram[bisect_left(self.buckets, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def timed(self, op):
+        ''' Decorator recording the latency of every call in the
+            solaredge_latency_seconds{op=..} histogram. For generator
+            functions the time spent producing the items is recorded.
+        '''
+        def decorator(func):
+            if isgeneratorfunction(func):
+                @wraps(func)
+                def generator(*args, **kwargs):
+                    if not self.enabled:
+                        yield from func(*args, **kwargs)
+                        return
+                    elapsed = 0.0
+                    items = func(*args, **kwargs)
+                    while True:
+                        start = perf_counter()
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            break
+                        finally:
+                            elapsed += perf_counter() - start
+                        yield item
+                    self.observe("solaredge_latency_seconds", elapsed, op=op)
+                return generator
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe("solaredge_latency_seconds",
+                                 perf_counter() - start, op=op)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    def prometheus(self):
+        ''' Output: metrics in the Prometheus text exposition format '''
+        def labelstr(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            if not labels:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(key, value)
+                                  for key, value in labels) + "}"
+
+        lines = []
+        with self._lock:
+            for kind, items in (("counter", self.counters),
+                                ("gauge", self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(items.items()):
+                    if name not in typed:
+                        typed.add(name)
+                        lines.append("# TYPE {} {}".format(name, kind))
+                    lines.append("{}{} {}".format(name, labelstr(labels),
+                                                  value))
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append("# TYPE {} histogram".format(name))
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",),
+                                        histogram[:-2]):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(
+                        name, labelstr(labels, le=bound), cumulative))
+                lines.append("{}_sum{} {}".format(name, labelstr(labels),
+                                                  histogram[-2]))
+                lines.append("{}_count{} {}".format(name, labelstr(labels),
+                                                    histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=None):
+        ''' Writes the text format atomically (textfile collector) '''
+        path = os.path.expanduser(path or SE_METRICS["file"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+    def summary(self):
+        ''' Output: one line with calls/mean/max bucket per op
+            and every counter, for the log
+        '''
+        parts = []
+        with self._lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if not histogram[-1]:
+                    continue
+                label = ",".join(str(value) for _, value in labels) or name
+                # upper bound of the highest occupied bucket
+                top = max(idx for idx, count in enumerate(histogram[:-2])
+                          if count)
+                bound = self.buckets[top] if top < len(self.buckets) \
+                    else "inf"
+                parts.append("{} n={} mean={:.1f}ms max<={}s".format(
+                    label, histogram[-1],
+                    histogram[-2] / histogram[-1] * 1000, bound))
+            for (name, labels), value in sorted(self.counters.items()) + \
+                    sorted(self.gauges.items()):
+                label = ",".join(str(item) for _, item in labels)
+                parts.append("{}{}={:g}".format(
+                    name, "[" + label + "]" if label else "", value))
+        return "; ".join(parts)
+
+
+registry = metrics_registry(SE_METRICS["enabled"], SE_METRICS["buckets"])
+timed = registry.timed
@@ -1,41 +1,87 @@
-from sqlalchemy import create_engine, MetaData, Column, Integer, text
+from sqlalchemy import create_engine, MetaData, Column, Integer, text, \
+    inspect, event, types
 from sqlalchemy_utils import database_exists, create_database
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
-from copy import deepcopy
-import requests
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Event, Thread
 
 from datetime import datetime, timedelta, timezone
 from calendar import monthrange
-from time import sleep
 
 from .config import \
     SQL_CREDENTIALS, \
     SQL_SSL, \
+    SQL_SQLITE, \
     SQL_DB_SCHEMAS, \
     SQL_SPLIT_TABLE_TIME, \
+    SQL_PARTITION_TIME, \
+    SQL_PARTITION_AHEAD, \
     SQL_DERIVATIVE_TABLES, \
-    SE_CREDENTIALS, \
+    SQL_CUMULATIVE_TABLES, \
     SE_API_TABLE, \
-    SQL_TABLES_PREFIX
+    SQL_TABLES_PREFIX, \
+    SQL_INSERT_BATCH_SIZE, \
+    SQL_RECENT_DAYS, \
+    SQL_SPOOL, \
+    SQL_RETENTION, \
+    SQL_ARCHIVE, \
+    SE_API, \
+    SE_API_WINDOW, \
+    SE_HISTORY_DEPTH, \
+    SE_COLUMNAR
+from .solaredge_client import solaredge_client, ApiError, QuotaExceeded
+from .columnar import energy_columns, np
+from .metrics import registry as metrics, timed
+from .ring_buffer import ring_buffer
+from .archive import energy_archive
+from .spool import write_spool
 
 Base = declarative_base()
 
 
 class mysql_client(object):
-    # todo language->db_type
-    def __init__(self, language):
+    ''' Storage client, language selects the backend ("mysql", "sqlite") '''
+    def __init__(self, language, api=None, site=None):
         self.language = language
+        # table namespace of the site (multi-site monitoring)
+        self.site = site
+        self.api = api if api else solaredge_client()
         self.database = ""
         self.db = None
         self.tz = timezone.utc
+        # process-lifetime schema cache {table: [column, ...]}
+        self.tables = {}
+        # running totals {(basetable, timespan): [periodStart, last, sums]}
+        self.rollup = {}
+        # rows of the rollup {basetable: (day, {Time: [value, ...]})}
+        self.folded = {}
+        # upper bound of the last range partition {table: datetime}
+        self.partitions = {}
+        # journal of rows the database didn't accept
+        self.spool = None
+        self._closed = Event()
+        # latest quarter-hour samples per base table
+        self.recent = {}
+        if SQL_RECENT_DAYS:
+            for basetable in set(SE_API_TABLE.values()):
+                meters = [column for column in SQL_DB_SCHEMAS[basetable]
+                          if column not in ('id', 'Time')]
+                self.recent[basetable] = ring_buffer(meters, SQL_RECENT_DAYS)
+        # first day of the cumulative index to recompute {basetable: day}
+        self.cumulative = {}
+        # memory-mapped copy of the quarter-hour rows {basetable: archive}
+        self.archive = {}
 
     # reuires CREATE USER 'user'@'x.x.x.%' IDENTIFIED VIA mysql_native_password USING '***';
     # GRANT ALL PRIVILEGES ON *.* TO 'user'@'x.x.x.%' REQUIRE NONE WITH GRANT OPTION MAX_QUERIES_PER_HOUR 0
     # MAX_CONNECTIONS_PER_HOUR 0 MAX_UPDATES_PER_HOUR 0 MAX_USER_CONNECTIONS 0;
 
     def create_connection(self, database, use_ssl):
-        dialect = {"mysql": "mysql+mysqldb"}
+        backends = {"mysql": self.__mysql_engine,
+                    "sqlite": self.__sqlite_engine}
         # todo derivative_table => summary tables
         tables = list(SQL_DB_SCHEMAS.keys())
         DB_TABLES = dict.fromkeys(tables, [datetime.now(tz=self.tz)])
@@ -43,8 +89,37 @@ class mysql_client(object):
             DB_TABLES[table].extend(references)
 
         self.database = database
+        if SQL_SPOOL["enabled"] and self.spool is None:
+            name = database + ("_" + self.site if self.site else "")
+            self.spool = write_spool(
+                os.path.join(SQL_SPOOL["path"], name + ".spool"),
+                SQL_SPOOL["max_mb"] * 2**20)
+            Thread(target=self.__flusher, daemon=True).start()
 
-        url = "{0}://{1}:{2}@{3}/{4}".format(dialect[self.language],
+        try:
+            self.db = backends[self.language](database, use_ssl)
+            # prime tables
+            self.invalidate_schema_cache()
+            tables = set([self.__map_table_name(table, reference)
+                          for table, references in DB_TABLES.items()
+                          for reference in references])
+            tables_missing = tables.difference(self.tables)
+            if tables_missing:
+                self.__create_table(tables_missing)
+            self.__migrate_time_index()
+            self.__partition_tables()
+            self.__load_recent()
+            self.__load_archive()
+            self.__check_cumulative()
+
+        except SQLAlchemyError as e:
+            error = str(e)
+            return error
+
+        return 0
+
+    def __mysql_engine(self, database, use_ssl):
+        url = "{0}://{1}:{2}@{3}/{4}".format("mysql+mysqldb",
                                              SQL_CREDENTIALS["user"],
                                              SQL_CREDENTIALS["password"],
                                              SQL_CREDENTIALS["host"],
@@ -56,160 +131,995 @@ class mysql_client(object):
         else:
             connect_args = {}
 
-        self.db = create_engine(url, connect_args=connect_args)
+        engine = create_engine(url, connect_args=connect_args)
+        if not database_exists(url):
+            create_database(url)
+        return engine
 
-        try:
-            if not database_exists(url):
-                create_database(url)
-            # prime tables
-            tables_present = set(self.db.table_names())
-            tables = set([self.__map_table_name(table, reference)
-                          for table, references in DB_TABLES.items()
-                          for reference in references])
-            tables_missing = tables.difference(tables_present)
-            if tables_missing:
-                self.__create_table(tables_missing)
+    def __sqlite_engine(self, database, use_ssl):
+        ''' Local database file <SQL_SQLITE["path"]>/<database>.db,
+            every connection is tuned with SQL_SQLITE["pragmas"]
+            (WAL journal etc.). SSL doesn't apply.
+        '''
+        path = os.path.expanduser(SQL_SQLITE["path"])
+        os.makedirs(path, exist_ok=True)
+        url = "sqlite:///" + os.path.join(path, database + ".db")
 
-        except SQLAlchemyError as e:
-            error = str(e)
-            return error
+        engine = create_engine(url)
 
-        return 0
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in SQL_SQLITE["pragmas"].items():
+                cursor.execute("PRAGMA {}={}".format(pragma, value))
+            cursor.close()
+
+        return engine
 
     def set_timezone(self, timezone):
         self.tz = timezone
+        self.api.set_timezone(timezone)
 
-    def get_api_response(self, api, slice=False, format=True, **kwargs):
+    def invalidate_schema_cache(self, table=None):
+        ''' Drops cached schema information.
+            Without a table the whole database is reflected again
+            (one round trip), otherwise the table is reflected lazily
+            on its next use.
+        '''
+        if table:
+            self.tables.pop(table, None)
+            return
 
-        apiKey = SE_CREDENTIALS["apiKey"]
-        siteID = SE_CREDENTIALS["siteID"]
-        url = "https://monitoringapi.solaredge.com/site/"+siteID+"/"+api+"?"
+        meta = MetaData()
+        meta.reflect(bind=self.db)
+        self.tables = {name: [col.name for col in tbl.c]
+                       for name, tbl in meta.tables.items()}
 
-        # api_key= is always sent
-        if not kwargs:
-            kwargs = {}
-        # kick None args
-        else:
-            kwargs = {key: value for key, value in kwargs.items()
-                      if value is not None}
-        kwargs['api_key'] = apiKey
+    def _get_columns(self, table):
+        ''' Returns the cached column names of a table,
+            reflecting only this table if it isn't cached yet.
+        '''
+        if table not in self.tables:
+            meta = MetaData()
+            meta.reflect(bind=self.db, only=[table])
+            self.tables[table] = [col.name for col in meta.tables[table].c]
+        return self.tables[table]
+
+    def get_api_response(self, api, slice=False, format=True,
+                         priority="high", **kwargs):
 
-        response = requests.get(url, params=kwargs)
-        json_data = response.json()
+        if format and api in ("powerDetails", "energyDetails"):
+            # meters are streamed into __format
+            meters = self.api.get_meters(api, priority=priority, **kwargs)
+            if isinstance(meters, int):
+                return meters
+            return self.__format({api: {"meters": meters}}, api, slice)
 
-        if response.status_code != 200:
-            return response.status_code
+        json_data = self.api.get_api_response(api, priority=priority,
+                                              **kwargs)
+
+        if not isinstance(json_data, dict):
+            return json_data
         elif not format:
             return json_data
         else:
             return self.__format(json_data, api, slice)
 
-    def to_sql(self, data, api, checkTime=False, summary=''):
+    def ingest(self, api, slice=False, checkTime=False, priority="high",
+               timeUnit="QUARTER_OF_AN_HOUR", startTime=None, endTime=None):
+        ''' Streams api data into the database. The range is fetched,
+            parsed, sliced and written one api-legal window at a time,
+            so memory stays bounded by a single window.
 
-        basetable = SE_API_TABLE[api]
-        meta = MetaData()
-        meta.reflect(bind=self.db)
+            Input: api, slice/checkTime as in get_api_response/to_sql,
+                   timeUnit, startTime/endTime as "%Y-%m-%d %H:%M:%S"
+            Output: number of rows written
+        '''
+        startTime = datetime.strptime(startTime, "%Y-%m-%d %H:%M:%S")
+        endTime = datetime.strptime(endTime, "%Y-%m-%d %H:%M:%S")
+        rows = 0
+        for window, _, windowStart, windowEnd in \
+                self._plan_windows(timeUnit, startTime, endTime):
+            data = self.get_api_response(
+                api, slice=slice, priority=priority, timeUnit=timeUnit,
+                startTime=windowStart.strftime("%Y-%m-%d %H:%M:%S"),
+                endTime=windowEnd.strftime("%Y-%m-%d %H:%M:%S"))
+            if isinstance(data, int):
+                raise ApiError("{} {} failed with HTTP {}".format(api, window,
+                                                                 data))
+            rows += self.to_sql(data, api, checkTime=checkTime)
+        return rows
 
+    @timed("to_sql")
+    def to_sql(self, data, api, checkTime=False, summary=''):
+        ''' Writes formatted chunks, output: number of rows written.
+            Chunks the database doesn't accept are spooled locally, as are
+            all chunks while older ones are still spooled (keeps the
+            order, no waiting on a database that is away).
+        '''
+        rows = 0
         for slice in data:
-            if isinstance(slice[0][0], datetime) and not summary:
-                reftime = slice[0][0]
-            elif summary:
-                reftime = summary
+            if not len(slice):
+                continue
+            elif self.spool is not None and self.spool.pending:
+                self.__spool(api, slice, checkTime, summary)
             else:
-                reftime = None
+                try:
+                    self.__write_slice(api, slice, checkTime, summary)
+                except SQLAlchemyError:
+                    if self.spool is None:
+                        raise
+                    self.__spool(api, slice, checkTime, summary)
+            rows += len(slice)
+        self.__refresh_cumulative(SE_API_TABLE[api])
+        return rows
 
-            table = self.__map_table_name(basetable, reftime)
-            if table not in self.db.table_names():
-                self.__create_table(table)
+    def __write_slice(self, api, slice, checkTime, summary):
+        basetable = SE_API_TABLE[api]
+        if isinstance(slice[0][0], datetime) and not summary:
+            reftime = slice[0][0]
+        elif summary:
+            reftime = summary
+        else:
+            reftime = None
 
-            columns = [col.name for col in meta.tables[table].c
-                       if col.name != "id"]
-            self.__sql_dump_data(slice, table, columns)
+        table = self.__map_table_name(basetable, reftime)
+        if table not in self.tables:
+            self.__create_table(table)
 
-            if checkTime and isinstance(reftime, datetime) \
-                    and reftime.strftime("%H:%M:%S") == "00:00:00":
-                # check date shift
-                for timespan in self.__check_date_shift(reftime):
-                    table = self.__map_table_name(basetable, timespan)
-                    slice = self.from_sql(basetable, reftime, timespan)
-                    self.__sql_dump_data(slice, table, columns)
+        columns = [col for col in self._get_columns(table)
+                   if col != "id"]
+        if table in self.partitions and \
+                slice[len(slice)-1][0] >= self.partitions[table]:
+            self.__extend_partitions(table, slice[len(slice)-1][0])
+        self.__sql_dump_data(slice, table, columns)
+        if isinstance(reftime, datetime) and basetable in self.recent \
+                and self.recent[basetable].meters == columns[1:]:
+            self.recent[basetable].extend(slice)
+        if isinstance(reftime, datetime) and basetable in self.archive \
+                and self.archive[basetable].meters == columns[1:]:
+            self.archive[basetable].write(slice)
+        metrics.count("solaredge_rows_written_total", len(slice),
+                      table=basetable)
 
+        if checkTime and isinstance(reftime, datetime):
+            # keep the open day/week/month/year rows current
+            self._fold_rollup(basetable, slice, columns)
+        elif summary == "day":
+            self.__mark_cumulative(basetable, slice[0][0])
+
+    def __spool(self, api, slice, checkTime, summary):
+        basetable = SE_API_TABLE[api]
+        self.spool.append(api, slice, checkTime, summary)
+        metrics.count("solaredge_rows_spooled_total", len(slice),
+                      table=basetable)
+        # recent samples stay current while the database is away
+        if not summary and isinstance(slice[0][0], datetime) and \
+                basetable in self.recent:
+            self.recent[basetable].extend(slice)
+        if not summary and isinstance(slice[0][0], datetime) and \
+                basetable in self.archive:
+            self.archive[basetable].write(slice)
+
+    def flush_spool(self):
+        ''' Writes the spooled chunks back (oldest first).
+
+            Output: True once the spool is empty
+        '''
+        if self.spool is None:
+            return True
+        try:
+            replayed = self.spool.drain(self.__write_slice,
+                                        SQL_SPOOL["batch"])
+        except SQLAlchemyError:
+            # still away, retried with the next flush
+            return False
+        metrics.count("solaredge_spool_replayed_total", replayed)
+        for basetable in list(self.cumulative):
+            self.__refresh_cumulative(basetable)
+        return not self.spool.pending
+
+    def __flusher(self):
+        while not self._closed.wait(SQL_SPOOL["flush_interval"]):
+            if self.spool.pending and self.db is not None:
+                self.flush_spool()
+
+    def close(self):
+        self._closed.set()
+        if self.spool is not None:
+            self.spool.close()
+
+    @timed("from_sql")
     def from_sql(self, basetable, time, timespan):
 
-        # time = datetime.now().replace(microsecond=0) if not time else time
+        return [self.aggregate(basetable, time, [timespan])[timespan]]
+
+    def aggregate(self, basetable, time, timespans):
+        ''' Sums every value column for several timespans at once.
+            All (timespan, column) sums are computed with conditional
+            aggregation in a single scan over the widest range.
+
+            Input: basetable, reference time, list of timespans
+                   ("today", "day", "week", "month", "year")
+            Output: {timespan: [endTime, sum, sum, ...]}
+        '''
         table = self.__map_table_name(basetable, time)
-        meta = MetaData()
-        meta.reflect(bind=self.db)
-        columns = [col.name for col in meta.tables[table].c
-                   if col.name != "id" and col.name != "Time"]
+        columns = [col for col in self._get_columns(table)
+                   if col != "id" and col != "Time"]
 
-        with self.db.connect() as connection:
-            data = []
-            # i do se a need for different math methods in the future
-            startTime, endTime = self._get_timespan(time, timespan)
+        bounds = {timespan: self._get_timespan(time, timespan)
+                  for timespan in timespans}
+        sums = self.__sum_ranges(table, columns, bounds)
+
+        return {timespan: [endTime] + sums[timespan]
+                for timespan, (_, endTime) in bounds.items()}
+
+    def __sum_ranges(self, table, columns, bounds):
+        ''' Input: table, value columns, {key: (startTime, endTime)}
+            Output: {key: [sum, sum, ...]}
+        '''
+        params = {}
+        selects = []
+        for idx, (startTime, endTime) in enumerate(bounds.values()):
+            params["start_{}".format(idx)] = \
+                startTime.strftime("%Y-%m-%d %H:%M:%S")
+            params["end_{}".format(idx)] = \
+                endTime.strftime("%Y-%m-%d %H:%M:%S")
             for column in columns:
-                str = text("SELECT SUM("+column+") FROM " + table
-                           + " WHERE Time BETWEEN :startTime AND :endTime")
-                # SQLAlchemy cant insert column/table as argumemt -> ProgrammingError
-                result = \
-                    connection.execute(str,
-                                       startTime=startTime.strftime(
-                                           "%Y-%m-%d %H:%M:%S"),
-                                       endTime=endTime.strftime(
-                                           "%Y-%m-%d %H:%M:%S")
-                                       ).fetchone()
-                # future (>2.0) implementation result.scalars[column].all()
-                data.append(result[0])
-            data.insert(0, endTime)
-
-        return [data]
-
-    def retrieve_historical_data(self):
-        # get start of solar production
-        timespan = self.get_api_response("dataPeriod")
-        startTime = "{} {}".format(timespan[0], "00:00:00")
-        endTime = datetime.now(tz=self.tz)
+                selects.append("SUM(CASE WHEN Time BETWEEN :start_{0} AND "
+                               ":end_{0} THEN {1} END)".format(idx, column))
+        params["startTime"] = min(params[key] for key in params
+                                  if key.startswith("start_"))
+        params["endTime"] = max(params[key] for key in params
+                                if key.startswith("end_"))
+
+        # SQLAlchemy cant insert column/table as argumemt -> ProgrammingError
+        sql = text("SELECT " + ','.join(selects) + " FROM " + table
+                   + " WHERE Time BETWEEN :startTime AND :endTime")
+        with self.db.connect() as connection:
+            result = connection.execute(sql, **params).fetchone()
+
+        return {key: list(result[idx*len(columns):(idx+1)*len(columns)])
+                for idx, key in enumerate(bounds.keys())}
+
+    def _fold_rollup(self, basetable, rows, columns):
+        ''' Folds new base rows into running day/week/month/year totals
+            and upserts the open period row of every derivative table.
+            Totals are seeded once per period (startup, period change),
+            afterwards every sample costs O(1). Rows folded before with
+            other values fold their difference (rows of earlier days
+            re-seed the totals).
+
+            Input: basetable, rows [Time, value, ...], columns of the rows
+        '''
+        touched = set()
+        # values folded per time of the latest day
+        day, folded = self.folded.get(basetable, (None, {}))
+        for row in rows:
+            time = row[0]
+            if not isinstance(time, datetime):
+                continue
+            values = [item or 0 for item in row[1:]]
+            previous = folded.get(time, None)
+            for timespan in SQL_DERIVATIVE_TABLES.get(basetable, []):
+                periodStart = self._get_period(time, timespan)[0]
+                total = self.rollup.get((basetable, timespan), None)
+                if not total or total[0] != periodStart:
+                    total = self.__seed_rollup(basetable, timespan,
+                                               periodStart, time, columns)
+                    self.rollup[(basetable, timespan)] = total
+                elif time <= total[1]:
+                    # already folded, a changed row (eg. the incomplete
+                    # last quarter-hour of a poll) folds its difference
+                    if previous == values:
+                        continue
+                    elif previous is None:
+                        total = self.__seed_rollup(
+                            basetable, timespan, periodStart,
+                            total[1] + timedelta(seconds=1), columns)
+                        self.rollup[(basetable, timespan)] = total
+                    else:
+                        total[2] = [value + item - before for value, item,
+                                    before in zip(total[2], values, previous)]
+                    touched.add(timespan)
+                    continue
+                total[1] = time
+                total[2] = [value + item
+                            for value, item in zip(total[2], values)]
+                touched.add(timespan)
+
+            rowDay = time.replace(hour=0, minute=0, second=0, microsecond=0)
+            if day is None or rowDay > day:
+                day, folded = rowDay, {}
+            if rowDay == day:
+                folded[time] = values
+        self.folded[basetable] = (day, folded)
+
+        for timespan in touched:
+            periodStart, _, sums = self.rollup[(basetable, timespan)]
+            table = self.__map_table_name(basetable, timespan)
+            if table not in self.tables:
+                self.__create_table(table)
+            self.__sql_dump_data([[periodStart] + sums], table, columns)
+            if timespan == "day":
+                self.__mark_cumulative(basetable, periodStart)
+
+    def __seed_rollup(self, basetable, timespan, periodStart, time, columns):
+        ''' Totals of a period up to (excluding) time.
+            Completed finer periods are read from their derivative table
+            (day for week/month, month for year), the rest from the base.
+
+            Output: [periodStart, last folded time, [sum, ...]]
+        '''
+        sums = [0] * (len(columns) - 1)
+        if time > periodStart:
+            finer = {"week": "day",
+                     "month": "day",
+                     "year": "month"}.get(timespan, None)
+            if finer in SQL_DERIVATIVE_TABLES.get(basetable, []):
+                finerStart = self._get_period(time, finer)[0]
+                if finerStart > periodStart:
+                    table = self.__map_table_name(basetable, finer)
+                    sums = self.__sum_ranges(
+                        table, columns[1:],
+                        {finer: (periodStart,
+                                 finerStart - timedelta(seconds=1))})[finer]
+                finerSums = self.__seed_rollup(basetable, finer, finerStart,
+                                               time, columns)[2]
+            elif basetable in self.recent and \
+                    self.recent[basetable].meters == columns[1:] and \
+                    self.recent[basetable].covers(periodStart):
+                finerSums = self.recent[basetable].sum(periodStart, time)
+            else:
+                table = self.__map_table_name(basetable, time)
+                finerSums = self.__sum_ranges(
+                    table, columns[1:],
+                    {timespan: (periodStart,
+                                time - timedelta(seconds=1))})[timespan]
+            sums = [(value or 0) + (item or 0)
+                    for value, item in zip(sums, finerSums)]
+
+        return [periodStart, time - timedelta(seconds=1), sums]
+
+    def recent_sum(self, basetable, startTime, endTime):
+        ''' Answers a recent window from memory.
+
+            Input: basetable, startTime/endTime as datetime
+            Output: {meter: sum} of startTime <= Time < endTime,
+                    None if the window isn't held in memory
+        '''
+        buffer = self.recent.get(basetable, None)
+        if buffer is None or not buffer.covers(startTime):
+            return None
+        return dict(zip(buffer.meters, buffer.sum(startTime, endTime)))
+
+    def archive_sums(self, basetable, meter, periods):
+        ''' Sums of a meter over several periods read from the archive
+            (eg. the Junes of the last years) without a database query.
+
+            Input: basetable, meter, periods [(startTime, endTime)] as
+                   datetime, startTime <= Time < endTime
+            Output: [sum, ...] in period order, None without archive
+        '''
+        archive = self.archive.get(basetable, None)
+        if archive is None or meter not in archive.meters:
+            return None
+        return [archive.sum(meter, startTime, endTime)
+                for startTime, endTime in periods]
+
+    def period_totals(self, basetable, periods):
+        ''' Totals of every meter per date range from the cumulative
+            index, two lookups per range whatever its span.
+
+            Input: basetable, periods [(startTime, endTime)] as datetime,
+                   the days of startTime up to endTime (included)
+            Output: [{meter: total} or None if a day of the range isn't
+                    stored, ...] in period order, None without index or
+                    if the database is away
+        '''
+        if basetable not in SQL_CUMULATIVE_TABLES:
+            return None
+        table = self.__map_table_name(basetable, "cumulative")
+        if table not in self.tables:
+            return None
+        self.__refresh_cumulative(basetable)
+        columns = [col for col in self._get_columns(table)
+                   if col not in ("id", "Time")]
+        sql = text("SELECT " + ','.join(columns) + " FROM " + table
+                   + " WHERE Time < :time ORDER BY Time DESC LIMIT 1")
+
+        # [first day, day after the last day)
+        bounds = [(startTime.replace(hour=0, minute=0, second=0,
+                                     microsecond=0),
+                   endTime.replace(hour=0, minute=0, second=0,
+                                   microsecond=0) + timedelta(days=1))
+                  for startTime, endTime in periods]
+        totals = []
+        try:
+            with self.db.connect() as connection:
+                def prefix(time):
+                    row = connection.execute(sql, time=time.strftime(
+                        "%Y-%m-%d %H:%M:%S")).fetchone()
+                    return dict(zip(columns, row)) if row else \
+                        dict.fromkeys(columns, 0)
+
+                for startTime, endTime in bounds:
+                    before, until = prefix(startTime), prefix(endTime)
+                    if until["Days"] - before["Days"] != \
+                            (endTime - startTime).days:
+                        totals.append(None)
+                        continue
+                    totals.append({column: (until[column] or 0)
+                                   - (before[column] or 0)
+                                   for column in columns
+                                   if column != "Days"})
+        except SQLAlchemyError:
+            # database away, the caller falls back to the api
+            return None
+        return totals
+
+    def __mark_cumulative(self, basetable, time):
+        ''' Day rows from time on changed, their prefixes are stale '''
+        if basetable not in SQL_CUMULATIVE_TABLES or \
+                not isinstance(time, datetime):
+            return
+        day = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        if basetable not in self.cumulative or \
+                day < self.cumulative[basetable]:
+            self.cumulative[basetable] = day
+
+    def __refresh_cumulative(self, basetable):
+        ''' Recomputes the cumulative rows from the first stale day on
+            (a single row for the open day of a storage cycle). Stays
+            stale if the database is away.
+        '''
+        day = self.cumulative.pop(basetable, None)
+        if day is None:
+            return
+        daytable = self.__map_table_name(basetable, "day")
+        table = self.__map_table_name(basetable, "cumulative")
+        try:
+            if table not in self.tables:
+                self.__create_table(table)
+            meters = [col for col in self._get_columns(daytable)
+                      if col not in ("id", "Time")]
+            extra = list(SQL_CUMULATIVE_TABLES[basetable])
+            params = {"day": day.strftime("%Y-%m-%d %H:%M:%S")}
+            with self.db.connect() as connection:
+                last = connection.execute(text(
+                    "SELECT " + ','.join(meters + extra) + " FROM " + table
+                    + " WHERE Time < :day ORDER BY Time DESC LIMIT 1"),
+                    **params).fetchone()
+                result = connection.execute(text(
+                    "SELECT Time, " + ','.join(meters) + " FROM " + daytable
+                    + " WHERE Time >= :day ORDER BY Time"), **params)
+                running = [value or 0 for value in last] if last else \
+                    [0] * (len(meters) + len(extra))
+                rows = []
+                counters = [1] * len(extra)
+                for row in result:
+                    running = [total + (value or 0) for total, value
+                               in zip(running, list(row[1:]) + counters)]
+                    rows.append([row[0]] + running)
+            self.__sql_dump_data(rows, table, ["Time"] + meters + extra)
+        except SQLAlchemyError:
+            self.__mark_cumulative(basetable, day)
+
+    def __check_cumulative(self):
+        ''' Marks the cumulative index stale from the first day row it
+            misses (or its last row, the open day) on connect.
+        '''
+        for basetable in SQL_CUMULATIVE_TABLES:
+            daytable = self.__map_table_name(basetable, "day")
+            table = self.__map_table_name(basetable, "cumulative")
+            if daytable not in self.tables:
+                continue
+            if table not in self.tables:
+                self.__create_table(table)
+            with self.db.connect() as connection:
+                first = connection.execute(text(
+                    "SELECT MIN(d.Time) FROM " + daytable + " d LEFT JOIN "
+                    + table + " c ON c.Time = d.Time WHERE c.Time IS NULL"
+                    )).scalar()
+                last = connection.execute(text(
+                    "SELECT MAX(Time) FROM " + table)).scalar()
+            for time in (first, last):
+                self.__mark_cumulative(basetable, self.__to_datetime(time))
+            self.__refresh_cumulative(basetable)
+
+    def plan_period_query(self, api, meter, timeUnit, startTime, endTime):
+        ''' Answers a period query from the derivative tables as far as
+            they cover the requested range.
+
+            Input: api, meter (column), timeUnit (DAY, WEEK, MONTH, YEAR),
+                   startTime/endTime as "%Y-%m-%d %H:%M:%S"
+            Output: None if the data isn't stored at all (the range is
+                    empty or the database away), else
+                    (values, gaps) with values in the api format
+                    [{"date": ..., "value": ...}] and gaps as merged
+                    [(startTime, endTime)] still to be fetched from the api
+        '''
+        basetable = SE_API_TABLE.get(api, None)
+        timespan = timeUnit.lower()
+        if not basetable or \
+                timespan not in SQL_DERIVATIVE_TABLES.get(basetable, []):
+            return None
+        table = self.__map_table_name(basetable, timespan)
+        if table not in self.tables or \
+                meter not in self._get_columns(table):
+            return None
+
+        startTime = datetime.strptime(startTime, "%Y-%m-%d %H:%M:%S")
+        endTime = datetime.strptime(endTime, "%Y-%m-%d %H:%M:%S")
+        periods = []
+        period = self._get_period(startTime, timespan)
+        while period[0] <= endTime:
+            periods.append(period)
+            period = self._get_period(period[1] + timedelta(seconds=1),
+                                      timespan)
+        if not periods:
+            return None
+
+        sql = text("SELECT Time, " + meter + " FROM " + table
+                   + " WHERE Time BETWEEN :startTime AND :endTime"
+                   + " ORDER BY Time")
+        stored = {}
+        try:
+            with self.db.connect() as connection:
+                result = connection.execute(
+                    sql,
+                    startTime=periods[0][0].strftime("%Y-%m-%d %H:%M:%S"),
+                    endTime=periods[-1][1].strftime("%Y-%m-%d %H:%M:%S"))
+                for time, value in result:
+                    period = self._get_period(self.__to_datetime(time),
+                                              timespan)
+                    stored[period[0]] = value
+        except SQLAlchemyError:
+            # database away, everything is fetched from the api
+            return None
+
+        values = []
+        gaps = []
+        for periodStart, periodEnd in periods:
+            if periodStart in stored:
+                item = {"date": periodStart.strftime("%Y-%m-%d %H:%M:%S")}
+                if stored[periodStart] is not None:
+                    item["value"] = stored[periodStart]
+                values.append(item)
+            elif gaps and gaps[-1][1] == periodStart - timedelta(seconds=1):
+                gaps[-1] = (gaps[-1][0], periodEnd)
+            else:
+                gaps.append((periodStart, periodEnd))
+
+        gaps = [(gapStart.strftime("%Y-%m-%d %H:%M:%S"),
+                 gapEnd.strftime("%Y-%m-%d %H:%M:%S"))
+                for gapStart, gapEnd in gaps]
+        return values, gaps
 
-        # monthly, weekly, yearly data
+    def retrieve_historical_data(self, checkpoints=None, progress=None):
+        ''' Loads the site history window by window.
+            Every timeUnit is split into api-legal windows which are fetched
+            on a small worker pool and stored as they arrive. Windows listed
+            in checkpoints were completed in an earlier run and are skipped
+            (or resumed from the stored endTime), after each completed window
+            progress is called so the caller can persist the checkpoint.
+
+            Input: checkpoints {window: endTime}, progress callback
+                   progress(window, endTime, done, total)
+            Output: True once every window is stored
+        '''
+        checkpoints = {} if checkpoints is None else checkpoints
         api = "energyDetails"
-        check = ["WEEK", "MONTH", "YEAR"]
-        for timeframe in check:
-            data = self.get_api_response(api,
-                                         timeUnit=timeframe,
-                                         startTime=startTime,
-                                         endTime=datetime.now(tz=self.tz)
-                                         .strftime("%Y-%m-%d %H:%M:%S"))
-            self.to_sql(data, api, summary=timeframe.lower())
-
-        # daily data is only present the last 365 days
-        startTime = (endTime - timedelta(days=364)
-                     ).strftime("%Y-%m-%d %H:%M:%S")
-        check = ["DAY"]
-        for timeframe in check:
-            data = self.get_api_response(api,
-                                         timeUnit=timeframe,
-                                         startTime=startTime,
-                                         endTime=datetime.now(tz=self.tz)
-                                         .strftime("%Y-%m-%d %H:%M:%S"))
-            self.to_sql(data, api, summary=timeframe.lower())
-
-        # quarterhour data is only present the last month
-        startTime = (endTime - timedelta(days=30)
-                     ).strftime("%Y-%m-%d %H:%M:%S")
-        table = SE_API_TABLE[api]
-        timespan = SQL_SPLIT_TABLE_TIME.get(table, False)
-        data = self.get_api_response(api, slice=timespan,
-                                     timeUnit="QUARTER_OF_AN_HOUR",
-                                     startTime=startTime,
-                                     endTime=datetime.now(tz=self.tz)
-                                     .strftime("%Y-%m-%d %H:%M:%S"))
-        self.to_sql(data, api)
+        endTime = datetime.now(tz=self.tz).replace(tzinfo=None)
+
+        # get start of solar production
+        timespan = self.get_api_response("dataPeriod", priority="low")
+        dataStart = datetime.strptime(timespan[0], "%Y-%m-%d")
+
+        # monthly, weekly, yearly data since the start of solar production
+        # daily and quarterhour data as deep as configured
+        windows = []
+        for timeUnit in ["WEEK", "MONTH", "YEAR", "DAY", "QUARTER_OF_AN_HOUR"]:
+            startTime = dataStart
+            if SE_HISTORY_DEPTH.get(timeUnit, None):
+                startTime = max(dataStart, (endTime - timedelta(
+                    days=SE_HISTORY_DEPTH[timeUnit])).replace(hour=0,
+                                                              minute=0,
+                                                              second=0,
+                                                              microsecond=0))
+            windows.extend(self._plan_windows(timeUnit, startTime, endTime))
+
+        pending = []
+        for window, timeUnit, startTime, windowEnd in windows:
+            stored = checkpoints.get(window, None)
+            if stored and stored >= windowEnd.strftime("%Y-%m-%d %H:%M:%S"):
+                continue
+            elif stored:
+                stored = datetime.strptime(stored, "%Y-%m-%d %H:%M:%S")
+                if timeUnit != "QUARTER_OF_AN_HOUR":
+                    # a summary period is only complete if fetched whole
+                    stored = self._get_period(stored, timeUnit.lower())[0]
+                startTime = max(startTime, stored)
+            pending.append((window, timeUnit, startTime, windowEnd))
+        done = len(windows) - len(pending)
+
+        workers = min(SE_API["concurrency"], 3)
+        # at most workers windows are fetched or held at a time, every
+        # window is released once it is stored
+        queue = iter(pending)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+
+            def submit():
+                window = next(queue, None)
+                if window:
+                    futures[pool.submit(self.__fetch_window, api,
+                                        *window)] = window
+
+            for _ in range(workers):
+                submit()
+            try:
+                while futures:
+                    for future in wait(futures,
+                                       return_when=FIRST_COMPLETED)[0]:
+                        window, timeUnit, _, windowEnd = futures.pop(future)
+                        data = future.result()
+                        if timeUnit == "QUARTER_OF_AN_HOUR":
+                            self.to_sql(data, api)
+                        else:
+                            self.to_sql(data, api, summary=timeUnit.lower())
+                        data = None
+
+                        done += 1
+                        checkpoints[window] = windowEnd.strftime(
+                            "%Y-%m-%d %H:%M:%S")
+                        if progress:
+                            progress(window, checkpoints[window], done,
+                                     len(windows))
+                        submit()
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
 
         # inventory information
         # TODO
 
         return True
 
+    def _plan_windows(self, timeUnit, startTime, endTime):
+        ''' Splits a range into windows the api serves in one request
+            (SE_API_WINDOW), aligned to calendar months/years.
+
+            Output: list of (window, timeUnit, startTime, endTime)
+        '''
+        limit = SE_API_WINDOW.get(timeUnit, None)
+        if not limit:
+            return [(timeUnit, timeUnit, startTime, endTime)]
+
+        windows = []
+        while startTime <= endTime:
+            periodStart, periodEnd = self._get_period(startTime, limit)
+            window = "{} {}".format(timeUnit, periodStart.strftime(
+                "%Y-%m" if limit == "month" else "%Y"))
+            windows.append((window, timeUnit, startTime,
+                            min(periodEnd, endTime)))
+            startTime = periodEnd + timedelta(seconds=1)
+        return windows
+
+    def __fetch_window(self, api, window, timeUnit, startTime, endTime,
+                       priority="low"):
+        if timeUnit == "QUARTER_OF_AN_HOUR":
+            slice = SQL_SPLIT_TABLE_TIME.get(SE_API_TABLE[api], False)
+        else:
+            slice = False
+        data = self.get_api_response(
+            api, slice=slice, priority=priority,
+            timeUnit=timeUnit,
+            startTime=startTime.strftime("%Y-%m-%d %H:%M:%S"),
+            endTime=endTime.strftime("%Y-%m-%d %H:%M:%S"))
+        if isinstance(data, int):
+            raise ApiError("{} {} failed with HTTP {}".format(api, window,
+                                                             data))
+        return data
+
+    def find_gaps(self, basetable, timeUnit, startTime, endTime):
+        ''' Missing intervals of the stored history. Only the Time column
+            is read (covered by its unique index), in order.
+
+            Input: basetable, timeUnit (QUARTER_OF_AN_HOUR: base and split
+                   tables, DAY: day table), startTime/endTime as datetime
+            Output: merged [(gapStart, gapEnd)] of the missing intervals
+        '''
+        if timeUnit == "DAY":
+            step = timedelta(days=1)
+            tables = [self.__map_table_name(basetable, "day")]
+            startTime = startTime.replace(hour=0, minute=0, second=0,
+                                          microsecond=0)
+        else:
+            step = timedelta(minutes=15)
+            tables = self.__split_tables(
+                self.__map_table_name(basetable, None))
+            startTime = startTime.replace(second=0, microsecond=0) - \
+                timedelta(minutes=startTime.minute % 15)
+
+        times = []
+        with self.db.connect() as connection:
+            for table in tables:
+                if table not in self.tables:
+                    continue
+                result = connection.execute(text(
+                    "SELECT Time FROM " + table + " WHERE Time BETWEEN "
+                    ":startTime AND :endTime ORDER BY Time"),
+                    startTime=startTime.strftime("%Y-%m-%d %H:%M:%S"),
+                    endTime=endTime.strftime("%Y-%m-%d %H:%M:%S"))
+                times.extend(self.__to_datetime(time) for time, in result)
+        times.sort()
+
+        gaps = []
+        expected = startTime
+        for time in times + [endTime + step]:
+            if time > expected:
+                gaps.append((expected, min(time - step, endTime)))
+            expected = max(expected, time + step)
+        return [(gapStart, gapEnd) for gapStart, gapEnd in gaps
+                if gapStart <= gapEnd]
+
+    def plan_repairs(self, gaps, timeUnit):
+        ''' Merges gaps into the fewest api-legal windows. A window starts
+            at a gap and takes every following gap that still fits into
+            the longest range the api serves (SE_API_WINDOW), stored rows
+            in between are simply fetched again.
+
+            Output: [(startTime, endTime)]
+        '''
+        limit = SE_API_WINDOW.get(timeUnit, None)
+        windows = []
+        for gapStart, gapEnd in sorted(gaps):
+            while True:
+                if windows and gapStart <= self.__window_end(windows[-1][0],
+                                                             limit):
+                    last = min(gapEnd,
+                               self.__window_end(windows[-1][0], limit))
+                    windows[-1] = (windows[-1][0], max(windows[-1][1], last))
+                else:
+                    last = min(gapEnd, self.__window_end(gapStart, limit))
+                    windows.append((gapStart, last))
+                if last >= gapEnd:
+                    break
+                gapStart = last + timedelta(seconds=1)
+        return windows
+
+    def __window_end(self, startTime, limit):
+        ''' Last second of an api window starting at startTime '''
+        if limit == "month":
+            year, month = divmod(startTime.month, 12)
+            year += startTime.year
+            month += 1
+        elif limit == "year":
+            year, month = startTime.year + 1, startTime.month
+        else:
+            return datetime.max
+        day = min(startTime.day, monthrange(year, month)[1])
+        return startTime.replace(year=year, month=month, day=day) - \
+            timedelta(seconds=1)
+
+    def repair_gaps(self, api="energyDetails", priority="low"):
+        ''' Fetches only the missing parts of the stored history: quarter-
+            hours of the last SE_HISTORY_DEPTH days and days since the first
+            stored day. Days with repaired quarter-hours are fetched again
+            as well, their day totals were summed from incomplete data,
+            and so are the week/month/year rows of the repaired days.
+
+            Output: {timeUnit: {"gaps": .., "windows": .., "rows": ..}}
+        '''
+        basetable = SE_API_TABLE[api]
+        now = datetime.now(tz=self.tz).replace(tzinfo=None)
+        # the running quarter-hour/day isn't complete yet
+        endTime = now.replace(second=0, microsecond=0) - \
+            timedelta(minutes=now.minute % 15 + 15)
+        report = {}
+
+        depth = SE_HISTORY_DEPTH.get("QUARTER_OF_AN_HOUR", None) or 30
+        gaps = self.find_gaps(basetable, "QUARTER_OF_AN_HOUR",
+                              now - timedelta(days=depth), endTime)
+        report["QUARTER_OF_AN_HOUR"] = self.__repair(
+            api, "QUARTER_OF_AN_HOUR", gaps, priority)
+        touched = [(gapStart.replace(hour=0, minute=0, second=0),
+                    gapEnd.replace(hour=0, minute=0, second=0))
+                   for gapStart, gapEnd in gaps]
+
+        table = self.__map_table_name(basetable, "day")
+        if table in self.tables:
+            with self.db.connect() as connection:
+                first = connection.execute(text(
+                    "SELECT MIN(Time) FROM " + table)).scalar()
+            if first:
+                gaps = self.find_gaps(basetable, "DAY",
+                                      self.__to_datetime(first),
+                                      now.replace(hour=0, minute=0, second=0,
+                                                  microsecond=0)
+                                      - timedelta(days=1))
+                report["DAY"] = self.__repair(api, "DAY", gaps + touched,
+                                              priority)
+                touched += gaps
+
+        # the open totals and the week/month/year rows of the repaired
+        # days were summed without them: totals re-seed, rows are fetched
+        for timespan in SQL_DERIVATIVE_TABLES.get(basetable, []):
+            if not touched:
+                break
+            periods = [(self._get_period(gapStart, timespan)[0],
+                        min(self._get_period(gapEnd, timespan)[1], endTime))
+                       for gapStart, gapEnd in touched]
+            total = self.rollup.get((basetable, timespan), None)
+            if total and any(periodStart <= total[0] <= periodEnd
+                             for periodStart, periodEnd in periods):
+                self.rollup.pop((basetable, timespan), None)
+            if timespan != "day":
+                report[timespan.upper()] = self.__repair(
+                    api, timespan.upper(), periods, priority)
+        return report
+
+    def __repair(self, api, timeUnit, gaps, priority):
+        windows = self.plan_repairs(gaps, timeUnit)
+        rows = 0
+        fetched = 0
+        for startTime, endTime in windows:
+            try:
+                data = self.__fetch_window(api, "repair", timeUnit,
+                                           startTime, endTime, priority)
+            except QuotaExceeded:
+                # the rest is repaired with the next scan
+                break
+            rows += self.to_sql(data, api, summary="" if timeUnit ==
+                                "QUARTER_OF_AN_HOUR" else timeUnit.lower())
+            fetched += 1
+        return {"gaps": len(gaps), "windows": len(windows),
+                "fetched": fetched, "rows": rows}
+
+    def apply_retention(self, api="energyDetails"):
+        ''' Compacts and deletes old quarter-hour rows (SQL_RETENTION).
+            Every transaction handles whole days: their hourly rows and
+            missing day rows are upserted from the raw rows, then the raw
+            rows are deleted. An interrupted run leaves consistent data and
+            continues next time. Stops once the off-peak hours are over.
+
+            Output: {"days": .., "hour_rows": .., "deleted": ..,
+                     "expired": .., "reclaimed_bytes": .., "complete": ..}
+                    (deleted raw rows, expired hourly rows)
+        '''
+        basetable = SE_API_TABLE[api]
+        now = datetime.now(tz=self.tz).replace(tzinfo=None)
+        raw_days = max(SQL_RETENTION["raw_days"],
+                       SE_HISTORY_DEPTH.get("QUARTER_OF_AN_HOUR", None) or 0)
+        cutoff = (now - timedelta(days=raw_days)).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        days = max(1, SQL_RETENTION["batch"] // 96)
+        report = {"days": 0, "hour_rows": 0, "deleted": 0, "expired": 0,
+                  "reclaimed_bytes": 0, "complete": True}
+
+        hourtable = self.__map_table_name(basetable, "hour")
+        daytable = self.__map_table_name(basetable, "day")
+        for table in (hourtable, daytable):
+            if table not in self.tables:
+                self.__create_table(table)
+        table = self.__map_table_name(basetable, None)
+        tables = self.__split_tables(table)
+        columns = [col for col in self._get_columns(table)
+                   if col not in ("id", "Time")]
+        if self.db.dialect.name == "sqlite":
+            hour = "strftime('%Y-%m-%d %H:00:00', Time)"
+            day = "strftime('%Y-%m-%d 00:00:00', Time)"
+            ignore = " ON CONFLICT(Time) DO NOTHING"
+        else:
+            hour = "DATE_ADD(DATE(Time), INTERVAL HOUR(Time) HOUR)"
+            day = "DATE(Time)"
+            ignore = " ON DUPLICATE KEY UPDATE Time=Time"
+        sums = ','.join("SUM(" + column + ")" for column in columns)
+        insert = "INSERT INTO {} (Time," + ','.join(columns) + ") SELECT {}," \
+            + sums + " FROM {} WHERE Time >= :startTime AND Time < :endTime" \
+            + " GROUP BY 1"
+
+        before = self.__free_bytes(tables + [hourtable])
+        for table in tables:
+            with self.db.connect() as connection:
+                first = connection.execute(text(
+                    "SELECT MIN(Time) FROM " + table)).scalar()
+            first = self.__to_datetime(first)
+            startTime = first.replace(hour=0, minute=0, second=0) \
+                if first else cutoff
+            while startTime < cutoff:
+                if not self.__off_peak():
+                    report["complete"] = False
+                    break
+                endTime = min(startTime + timedelta(days=days), cutoff)
+                params = {"startTime": startTime.strftime("%Y-%m-%d %H:%M:%S"),
+                          "endTime": endTime.strftime("%Y-%m-%d %H:%M:%S")}
+                with self.db.connect() as connection:
+                    with connection.begin():
+                        report["hour_rows"] += connection.execute(text(
+                            insert.format(hourtable, hour, table)
+                            + self.__upsert_clause(["Time"] + columns)),
+                            **params).rowcount
+                        connection.execute(text(
+                            insert.format(daytable, day, table) + ignore),
+                            **params)
+                        report["deleted"] += connection.execute(text(
+                            "DELETE FROM " + table + " WHERE Time >= "
+                            ":startTime AND Time < :endTime"),
+                            **params).rowcount
+                self.__mark_cumulative(basetable, startTime)
+                report["days"] += (endTime - startTime).days
+                startTime = endTime
+            if table in self.partitions:
+                # only partitions whose rows were compacted
+                self.__drop_partitions(table, min(startTime, cutoff))
+
+        # hourly rows expire as well, the day/week/month/year rows stay
+        expiry = (now - timedelta(days=SQL_RETENTION["hour_days"])).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        while self.__off_peak():
+            with self.db.connect() as connection:
+                if self.db.dialect.name == "sqlite":
+                    deleted = connection.execute(text(
+                        "DELETE FROM " + hourtable + " WHERE id IN (SELECT id"
+                        " FROM " + hourtable + " WHERE Time < :expiry"
+                        " LIMIT :batch)"), expiry=expiry.strftime(
+                            "%Y-%m-%d %H:%M:%S"),
+                        batch=SQL_RETENTION["batch"]).rowcount
+                else:
+                    deleted = connection.execute(text(
+                        "DELETE FROM " + hourtable + " WHERE Time < :expiry"
+                        " LIMIT " + str(int(SQL_RETENTION["batch"]))),
+                        expiry=expiry.strftime("%Y-%m-%d %H:%M:%S")).rowcount
+            report["expired"] += deleted
+            if deleted < SQL_RETENTION["batch"]:
+                break
+
+        report["reclaimed_bytes"] = self.__free_bytes(tables + [hourtable]) \
+            - before
+        self.__refresh_cumulative(basetable)
+        return report
+
+    def __off_peak(self):
+        start, end = SQL_RETENTION["off_peak"]
+        hour = datetime.now(tz=self.tz).hour
+        return start <= hour < end if start <= end \
+            else hour >= start or hour < end
+
+    def __free_bytes(self, tables):
+        ''' Space of deleted rows the database can reuse (SQLite: free
+            pages of the file, MySQL: DATA_FREE of the tables)
+        '''
+        with self.db.connect() as connection:
+            if self.db.dialect.name == "sqlite":
+                free = connection.execute(text(
+                    "PRAGMA freelist_count")).scalar()
+                return free * connection.execute(text(
+                    "PRAGMA page_size")).scalar()
+            return sum(connection.execute(text(
+                "SELECT DATA_FREE FROM information_schema.TABLES"
+                " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"),
+                table=table).scalar() or 0 for table in tables)
+
+    def __drop_partitions(self, table, cutoff):
+        ''' Drops the (emptied) partitions that end at or before cutoff,
+            which returns their files to the file system
+        '''
+        with self.db.connect() as connection:
+            names = [name for name, bound in connection.execute(text(
+                "SELECT PARTITION_NAME, PARTITION_DESCRIPTION"
+                " FROM information_schema.PARTITIONS"
+                " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"
+                " AND PARTITION_NAME IS NOT NULL"), table=table)
+                if name != "pmax"
+                and self.__to_datetime(bound.strip("'")) <= cutoff]
+            if names:
+                connection.execute(text(
+                    "ALTER TABLE " + table + " DROP PARTITION "
+                    + ','.join(names)))
+
     def _get_timespan(self, time, timespan):
 
         def leap(time): return 1 if ((time.year-1) % 4 == 0) else 0
@@ -232,20 +1142,60 @@ class mysql_client(object):
 
         return startTime, endTime
 
+    def _get_period(self, time, timespan):
+        ''' Start and end (last second) of the day, week, month
+            or year containing time.
+        '''
+        startTime = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        if timespan == "week":
+            startTime -= timedelta(days=startTime.weekday())
+            endTime = startTime + timedelta(days=7)
+        elif timespan == "month":
+            startTime = startTime.replace(day=1)
+            endTime = startTime + \
+                timedelta(days=monthrange(startTime.year, startTime.month)[1])
+        elif timespan == "year":
+            startTime = startTime.replace(month=1, day=1)
+            endTime = startTime.replace(year=startTime.year+1)
+        else:
+            endTime = startTime + timedelta(days=1)
+
+        return startTime, endTime - timedelta(seconds=1)
+
     def __sql_dump_data(self, slice, table, columns):
+        ''' Upserts rows with parameterized multi-row inserts.
+            Every batch of SQL_INSERT_BATCH_SIZE rows is sent as one
+            executemany, the whole slice is committed in one transaction.
+            Rows with a known Time replace the stored values, so retries
+            and re-ingests don't create duplicates.
+
+            Input: list of rows (Time first, values in column order)
+        '''
+        if not slice:
+            return
+
+        sql = "INSERT INTO " + table \
+            + " (" + ','.join(columns) + ") VALUES (" \
+            + ','.join(":" + column for column in columns) + ")"
+        sql = text(sql + self.__upsert_clause(columns))
 
         with self.db.connect() as connection:
-            for row in slice:
-                for idx, item in enumerate(row):
-                    if isinstance(item, datetime):
-                        row[idx] = "'"+item.strftime("%Y-%m-%d %H:%M:%S")+"'"
-                    else:
-                        row[idx] = str(item)
+            with connection.begin():
+                for batch in range(0, len(slice), SQL_INSERT_BATCH_SIZE):
+                    rows = [dict(zip(columns, row)) for row in
+                            slice[batch:batch+SQL_INSERT_BATCH_SIZE]]
+                    connection.execute(sql, rows)
 
-                sql = text("INSERT INTO "+table
-                           + " ("+','.join(columns)+") VALUES ("+','.join(row)+")")
-                connection.execute(sql)
-                sleep(0.2)
+    def __upsert_clause(self, columns):
+        ''' Output: clause replacing the values of rows with a known Time '''
+        values = [column for column in columns if column != "Time"]
+        if self.db.dialect.name == "sqlite":
+            return " ON CONFLICT(Time) DO UPDATE SET " \
+                + ','.join(column + "=excluded." + column
+                           for column in values)
+        return " ON DUPLICATE KEY UPDATE " \
+            + ','.join(column + "=VALUES(" + column + ")"
+                       for column in values)
 
     def __map_table_name(self, table, reference):
         ''' Helper method to construct the table names.
@@ -254,16 +1204,20 @@ class mysql_client(object):
             Input: str or list of str
             Output: str or list of str
         '''
-        # apply prefix
+        basename = table
+        # apply site namespace and prefix
         prefix = SQL_TABLES_PREFIX.get(table.rsplit('_', 1)[0], None)
+        if self.site:
+            table = "{}_{}".format(self.site, table)
         if prefix:
             table = "{}_{}".format(prefix, table)
 
         if isinstance(reference, str):
             table = "{}_{}".format(table, reference)
-        else:
+        elif reference is not None and basename not in SQL_PARTITION_TIME:
             for splittable, timer in SQL_SPLIT_TABLE_TIME.items():
-                if splittable == table:
+                timer = timer.upper()
+                if splittable == basename:
                     if timer == "DAY":
                         table = "{}_{}_{}_{}".format(table,
                                                      reference.day,
@@ -287,6 +1241,210 @@ class mysql_client(object):
 
         return table
 
+    def __migrate_time_index(self):
+        ''' Adds the unique Time index to tables created before it was
+            part of the schema. Duplicate rows are removed first (the
+            latest insert is kept).
+        '''
+        inspector = inspect(self.db)
+        with self.db.connect() as connection:
+            for table in self.tables:
+                basename = self.__base_name(table)
+                if not basename or not \
+                        SQL_DB_SCHEMAS[basename]['Time'][1].get('unique'):
+                    continue
+                indexes = inspector.get_indexes(table) + \
+                    inspector.get_unique_constraints(table)
+                if any(index['column_names'] == ['Time'] and
+                       index.get('unique', True) for index in indexes):
+                    continue
+
+                with connection.begin():
+                    connection.execute(text(
+                        "DELETE FROM " + table + " WHERE id NOT IN "
+                        "(SELECT id FROM (SELECT MAX(id) AS id FROM " + table
+                        + " GROUP BY Time) AS latest)"))
+                    connection.execute(text(
+                        "CREATE UNIQUE INDEX uq_" + table + "_Time ON "
+                        + table + " (Time)"))
+
+    def __load_recent(self):
+        ''' Rebuilds the in-memory samples of the last SQL_RECENT_DAYS '''
+        now = datetime.now(tz=self.tz).replace(tzinfo=None)
+        startTime = now - timedelta(days=SQL_RECENT_DAYS)
+        for basetable, buffer in self.recent.items():
+            buffer.clear()
+            table = self.__map_table_name(basetable, now)
+            if table not in self.tables:
+                continue
+            sql = text("SELECT Time, " + ','.join(buffer.meters) + " FROM "
+                       + table + " WHERE Time >= :startTime ORDER BY Time")
+            with self.db.connect() as connection:
+                result = connection.execute(
+                    sql, startTime=startTime.strftime("%Y-%m-%d %H:%M:%S"))
+                buffer.extend([self.__to_datetime(row[0])] + list(row[1:])
+                              for row in result)
+
+    def __load_archive(self):
+        ''' Opens the archives (SQL_ARCHIVE, numpy only). An empty
+            archive is filled from the base and split tables once,
+            oldest table first.
+        '''
+        if not SQL_ARCHIVE["enabled"] or np is None or self.archive:
+            return
+        folder = self.database + ("_" + self.site if self.site else "")
+        for basetable in set(SE_API_TABLE.values()):
+            meters = [column for column in SQL_DB_SCHEMAS[basetable]
+                      if column not in ('id', 'Time')]
+            archive = energy_archive(
+                os.path.join(SQL_ARCHIVE["path"], folder, basetable), meters)
+            self.archive[basetable] = archive
+            if len(archive):
+                continue
+
+            table = self.__map_table_name(basetable, None)
+            with self.db.connect() as connection:
+                tables = []
+                for name in self.__split_tables(table):
+                    first = connection.execute(text(
+                        "SELECT MIN(Time) FROM " + name)).scalar()
+                    if first is not None:
+                        tables.append((str(first), name))
+                for _, name in sorted(tables):
+                    result = connection.execute(text(
+                        "SELECT Time, " + ','.join(meters) + " FROM " + name
+                        + " ORDER BY Time"))
+                    while True:
+                        rows = result.fetchmany(SQL_ARCHIVE["batch"])
+                        if not rows:
+                            break
+                        archive.write([self.__to_datetime(row[0])]
+                                      + list(row[1:]) for row in rows)
+
+    def __partition_tables(self):
+        ''' Sets up the tables of SQL_PARTITION_TIME: split tables are
+            moved into the table and (MySQL) it is partitioned by
+            RANGE COLUMNS(Time), one partition per period plus a
+            catch-all pmax. Range queries on Time are pruned to the
+            partitions of their periods.
+        '''
+        for basetable, timespan in SQL_PARTITION_TIME.items():
+            table = self.__map_table_name(basetable, None)
+            self.__merge_split_tables(table)
+            if self.db.dialect.name != "mysql":
+                continue
+
+            with self.db.connect() as connection:
+                bounds = [bound for name, bound in connection.execute(text(
+                    "SELECT PARTITION_NAME, PARTITION_DESCRIPTION"
+                    " FROM information_schema.PARTITIONS"
+                    " WHERE TABLE_SCHEMA = DATABASE()"
+                    " AND TABLE_NAME = :table"
+                    " AND PARTITION_NAME IS NOT NULL"), table=table)
+                    if name != "pmax"]
+                if bounds:
+                    self.partitions[table] = max(
+                        self.__to_datetime(bound.strip("'"))
+                        for bound in bounds)
+                else:
+                    first = connection.execute(text(
+                        "SELECT MIN(Time) FROM " + table)).scalar()
+                    first = first or datetime.now(tz=self.tz) \
+                        .replace(tzinfo=None)
+                    # every unique key has to contain the partition column
+                    connection.execute(text(
+                        "ALTER TABLE " + table + " DROP PRIMARY KEY,"
+                        " ADD PRIMARY KEY (id, Time)"))
+                    connection.execute(text(
+                        "ALTER TABLE " + table
+                        + " PARTITION BY RANGE COLUMNS(Time) ("
+                        + self.__partition_definitions(table, first)
+                        + ")"))
+            self.__extend_partitions(table)
+
+    def __extend_partitions(self, table, time=None):
+        ''' Splits new periods off pmax up to SQL_PARTITION_AHEAD periods
+            after time (default now)
+        '''
+        if self.db.dialect.name != "mysql" or table not in self.partitions:
+            return
+        definitions = self.__partition_definitions(
+            table, self.partitions[table], time)
+        if definitions == "PARTITION pmax VALUES LESS THAN (MAXVALUE)":
+            return
+        with self.db.connect() as connection:
+            connection.execute(text(
+                "ALTER TABLE " + table + " REORGANIZE PARTITION pmax INTO ("
+                + definitions + ")"))
+
+    def __partition_definitions(self, table, startTime, time=None):
+        ''' Partitions of the periods from startTime until
+            SQL_PARTITION_AHEAD periods after time, followed by pmax.
+            Updates the last bound of the table.
+        '''
+        timespan = SQL_PARTITION_TIME[self.__base_name(table)].lower()
+        time = time or datetime.now(tz=self.tz).replace(tzinfo=None)
+        for _ in range(SQL_PARTITION_AHEAD):
+            time = self._get_period(time, timespan)[1] + timedelta(seconds=1)
+
+        definitions = []
+        periodStart = startTime
+        while periodStart <= time:
+            periodStart, periodEnd = self._get_period(periodStart, timespan)
+            periodEnd += timedelta(seconds=1)
+            definitions.append("PARTITION p{} VALUES LESS THAN ('{}')".format(
+                periodStart.strftime("%Y%m%d"),
+                periodEnd.strftime("%Y-%m-%d %H:%M:%S")))
+            self.partitions[table] = periodStart = periodEnd
+        definitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+        return ", ".join(definitions)
+
+    def __merge_split_tables(self, table):
+        ''' Moves the rows of split tables (<table>_<period>) into table
+            and drops them
+        '''
+        columns = [col for col in self._get_columns(table) if col != "id"]
+        for splittable in sorted(self.__split_tables(table)):
+            if splittable == table:
+                continue
+            with self.db.connect() as connection:
+                with connection.begin():
+                    connection.execute(text(
+                        "INSERT INTO " + table + " (" + ','.join(columns)
+                        + ") SELECT " + ','.join(columns) + " FROM "
+                        + splittable + " WHERE 1"
+                        + self.__upsert_clause(columns)))
+                connection.execute(text("DROP TABLE " + splittable))
+            self.invalidate_schema_cache(splittable)
+
+    def __split_tables(self, table):
+        ''' Output: [table and its split tables (<table>_<period>)]
+                    as far as they exist
+        '''
+        split = re.compile(re.escape(table) + r"(_\d+)+$")
+        return [name for name in self.tables
+                if name == table or split.match(name)]
+
+    def __to_datetime(self, value):
+        ''' Output: a stored Time as datetime (SQLite returns strings) '''
+        if isinstance(value, str):
+            return datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S")
+        return value
+
+    def __base_name(self, table):
+        ''' Schema name of a (prefixed, split or derivative) table '''
+        prefixes = [item+"_" for item in SQL_TABLES_PREFIX.values()
+                    if table.startswith(item+"_")]
+        name = table[len(prefixes[0]):] if prefixes else table
+        if self.site:
+            if not name.startswith(self.site + "_"):
+                return None
+            name = name[len(self.site)+1:]
+        for basename in SQL_DB_SCHEMAS:
+            if name == basename or name.startswith(basename+"_"):
+                return basename
+        return None
+
     def __create_table(self, tables):
         ''' Creates new table.
 
@@ -295,22 +1453,25 @@ class mysql_client(object):
         Base = declarative_base()
 
         if isinstance(tables, str):
-            tables = (tables)
+            tables = [tables]
 
         for table in tables:
             # remove prefix and affix (to apply DB schema)
-            prefixes = [item+"_" for item in SQL_TABLES_PREFIX.values()
-                        if item+"_" in table]
-            prefix = prefixes[0] if prefixes else ''
-            basename = table.replace(prefix, '').rsplit('_', 1)[0]
+            basename = self.__base_name(table)
 
-            kwargs = deepcopy(SQL_DB_SCHEMAS[basename])
+            schema = dict(SQL_DB_SCHEMAS[basename])
+            if table == self.__map_table_name(basename, "cumulative"):
+                schema.update(SQL_CUMULATIVE_TABLES.get(basename, {}))
+            kwargs = {name: Column(getattr(types, type_), **options)
+                      for name, (type_, options) in schema.items()}
             kwargs['__tablename__'] = table
             # injects args in skeleton Class
-            table = type('Tables', (Base,), kwargs)
+            type('Tables', (Base,), kwargs)
+            self.tables[table] = list(schema.keys())
 
         Base.metadata.create_all(self.db)
 
+    @timed("format")
     def __format(self, jsonObj, api, slice=False):
 
         data = []
@@ -321,19 +1482,36 @@ class mysql_client(object):
             _schema = [item for item in
                        SQL_DB_SCHEMAS[table].keys()
                        if item not in ('id', 'Time')]
-            # todo sort order key for different apis
-            jdata = sorted(jdata,
-                           key=lambda x: _schema.index(x['type']))
-            data = [[datetime.strptime(item["date"], "%Y-%m-%d %H:%M:%S")]
-                    for item in jdata[0]["values"]]
-            for idx, time in enumerate(data):
-                for meter in jdata:
-                    data[idx].append(
-                        meter['values'][idx].get('value', float(0)))
-
-            # delete last entry since it isincomplete data
-            if len(data) > 1:
-                del data[-1]
+            if np is not None and SE_COLUMNAR:
+                data = energy_columns.from_json(jdata, _schema)
+            else:
+                # todo sort order key for different apis
+                jdata = sorted(jdata,
+                               key=lambda x: _schema.index(x['type']))
+                data = [[datetime.strptime(item["date"],
+                                           "%Y-%m-%d %H:%M:%S")]
+                        for item in jdata[0]["values"]]
+                for idx, time in enumerate(data):
+                    for meter in jdata:
+                        data[idx].append(
+                            meter['values'][idx].get('value', float(0)))
+
+            # delete last entry if its period isn't over (incomplete data)
+            timeUnit = jsonObj[api].get("timeUnit", None)
+            if len(data):
+                last = data[len(data)-1][0]
+                if timeUnit in ("QUARTER_OF_AN_HOUR", "HOUR"):
+                    end = last + timedelta(
+                        minutes=15 if timeUnit != "HOUR" else 60, seconds=-1)
+                elif timeUnit in ("DAY", "WEEK", "MONTH", "YEAR"):
+                    end = self._get_period(last, timeUnit.lower())[1]
+                elif len(data) > 1:
+                    # unknown unit, the step of the previous entry
+                    end = last + (last - data[len(data)-2][0])
+                else:
+                    end = last
+                if end >= datetime.now(tz=self.tz).replace(tzinfo=None):
+                    data = data[:-1]
             data = [data]
 
         elif api == "dataPeriod":
@@ -344,36 +1522,36 @@ class mysql_client(object):
             data = self._slice_data(data, slice)
         return data
 
+    @timed("slice_data")
     def _slice_data(self, data, slice):
+        ''' Splits every chunk of data at day, week, month or year
+            boundaries in a single pass. Chunks are yielded lazily as
+            slices of the formatted data (views for energy_columns).
 
-        def check_timeframe(item, slice):
-            if slice == "day":
-                return item.strftime("%H:%M:%S") == "00:00:00"
-            elif slice == "week":
-                return item.weekday() == 0 and item.strftime("%H:%M:%S") == "00:00:00"
-            elif slice == "month":
-                return item.day == 1 and item.strftime("%H:%M:%S") == "00:00:00"
-            elif slice == "year":
-                return item.month == 1 and item.day == 1 and item.strftime("%H:%M:%S") == "00:00:00"
+            Input: list of chunks (row lists or energy_columns),
+                   slice ("day", "week", "month", "year")
+            Output: generator of chunks
+        '''
+        slice = slice.lower()
+        # integer key of the period a timestamp belongs to
+        # (date.toordinal() 1 is a monday)
+        period_key = {"day": lambda time: time.toordinal(),
+                      "week": lambda time: (time.toordinal() - 1) // 7,
+                      "month": lambda time: time.year * 12 + time.month,
+                      "year": lambda time: time.year}[slice]
+
+        for chunk in data:
+            if isinstance(chunk, energy_columns):
+                bounds = chunk.boundaries(slice)
             else:
-                return item
-
-        x = data[-1]
-        for idx, item in enumerate(x):
-            if len(x) > 1 and isinstance(item[0], datetime) and \
-                    check_timeframe(item[0], slice):
-                data[-1] = x[:idx]
-                data.append(x[idx:])
-                self._slice_data(data, slice)
-        else:
-            return data
-
-    def __check_date_shift(self, time):
-        checkTime = [("day", time.strftime("%H:%M:%S") == "00:00:00"),
-                     ("week", time.weekday() == 0),
-                     ("month", time.day == 1),
-                     ("year", time.day == 1 and time.month == 1)]
-        return [timespan for timespan, needed in checkTime if needed]
+                keys = [period_key(row[0]) if isinstance(row[0], datetime)
+                        else None for row in chunk]
+                bounds = [idx for idx in range(1, len(keys))
+                          if keys[idx] != keys[idx-1]]
+            bounds = [0] + bounds + [len(chunk)]
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                if end > start:
+                    yield chunk[start:end]
 
     # skeleton Class for dynamic table creation
     class Tables(Base):
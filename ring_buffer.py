@@ -0,0 +1,108 @@
+from array import array
+from datetime import datetime, timezone
+from threading import Lock
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class ring_buffer(object):
+    ''' Fixed-size in-memory buffer of the latest samples of one interval
+        (quarter-hours), one float array per meter.
+        Every slot stores the running total of its meter, so appending and
+        summing any range inside the buffer are O(1). Missing samples
+        count as 0, samples older than the buffer are dropped.
+    '''
+    def __init__(self, meters, days=7, interval=900):
+        self.meters = list(meters)
+        self.interval = interval
+        self.size = max(1, int(days * 86400 // interval))
+        # running totals per meter, sample s is held in slot s % size
+        self.totals = [array('d', [0.0]) * self.size for _ in self.meters]
+        # running totals before the oldest sample
+        self.base = [0.0] * len(self.meters)
+        self.first = None
+        self.last = None
+        self._lock = Lock()
+
+    def __len__(self):
+        return 0 if self.last is None else self.last - self.first + 1
+
+    def extend(self, rows):
+        ''' Input: rows [Time, value, ...] with values in meter order '''
+        with self._lock:
+            for row in rows:
+                time = row[0]
+                if not isinstance(time, datetime):
+                    continue
+                self.__put(self.__sample(time), row[1:])
+
+    def covers(self, startTime):
+        ''' Output: True if every sample from startTime on is held '''
+        return self.first is not None and \
+            self.__sample(startTime) >= self.first
+
+    def sum(self, startTime, endTime):
+        ''' Sums of the samples with startTime <= Time < endTime
+            (clipped to the samples held).
+
+            Output: [sum, ...] in meter order
+        '''
+        with self._lock:
+            if self.last is None:
+                return [0.0] * len(self.meters)
+            start = max(self.__sample(startTime) - 1, self.first - 1)
+            end = min(self.__sample(endTime) - 1, self.last)
+            if end <= start:
+                return [0.0] * len(self.meters)
+            return [self.__total(meter, end) - self.__total(meter, start)
+                    for meter in range(len(self.meters))]
+
+    def clear(self):
+        with self._lock:
+            self.first = self.last = None
+
+    def __sample(self, time):
+        if time.tzinfo is not None:
+            time = time.astimezone(timezone.utc).replace(tzinfo=None)
+        return int((time - EPOCH).total_seconds()) // self.interval
+
+    def __total(self, meter, sample):
+        if sample < self.first:
+            return self.base[meter]
+        return self.totals[meter][sample % self.size]
+
+    def __put(self, sample, values):
+        values = [value or 0.0 for value in values]
+        if self.last is None or sample > self.last + self.size:
+            # (re)start with this sample
+            self.first = self.last = sample
+            self.base = [0.0] * len(self.meters)
+            for meter, value in enumerate(values):
+                self.totals[meter][sample % self.size] = value
+        elif sample > self.last:
+            # gaps are filled with 0
+            zeros = [0.0] * len(self.meters)
+            for missing in range(self.last + 1, sample):
+                self.__append(missing, zeros)
+            self.__append(sample, values)
+        elif sample >= self.first:
+            # correction of a held sample, the later totals shift
+            delta = [value - self.__total(meter, sample)
+                     + self.__total(meter, sample - 1)
+                     for meter, value in enumerate(values)]
+            for following in range(sample, self.last + 1):
+                idx = following % self.size
+                for meter, change in enumerate(delta):
+                    self.totals[meter][idx] += change
+
+    def __append(self, sample, values):
+        idx = sample % self.size
+        if self.last - self.first + 1 == self.size:
+            # the oldest sample (same slot) is overwritten
+            for meter in range(len(self.meters)):
+                self.base[meter] = self.totals[meter][idx]
+            self.first += 1
+        for meter, value in enumerate(values):
+            self.totals[meter][idx] = \
+                self.totals[meter][self.last % self.size] + value
+        self.last = sample
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta, timezone
+from math import sin, cos, acos, asin, radians, degrees, ceil
+
+J2000 = datetime(2000, 1, 1, 12, tzinfo=timezone.utc)
+
+
+class poll_scheduler(object):
+    ''' Plans the storage polls.
+        Polls are aligned to interval boundaries (quarter-hours) plus a
+        settle delay, so the last interval is complete at the api. Between
+        sunset and sunrise (plus twilight) nothing is polled, the first
+        poll of the morning fetches the night in one request. If the
+        daily request budget can't cover a poll per interval until the
+        evening the interval is stretched.
+    '''
+    def __init__(self, interval=900, settle=300, twilight=1800,
+                 latitude=None, longitude=None):
+        self.interval = interval
+        self.settle = settle
+        self.twilight = timedelta(seconds=twilight)
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def sun_times(self, day):
+        ''' Sunrise equation (NOAA approximation, about a minute off).
+
+            Input: date
+            Output: (sunrise, sunset) as UTC datetimes,
+                    None without coordinates or on polar days/nights
+        '''
+        if self.latitude is None or self.longitude is None:
+            return None
+        days = (day - J2000.date()).days - self.longitude / 360
+        anomaly = (357.5291 + 0.98560028 * days) % 360
+        center = 1.9148 * sin(radians(anomaly)) \
+            + 0.02 * sin(radians(2 * anomaly)) \
+            + 0.0003 * sin(radians(3 * anomaly))
+        ecliptic = (anomaly + center + 282.9372) % 360
+        transit = days + 0.0053 * sin(radians(anomaly)) \
+            - 0.0069 * sin(radians(2 * ecliptic))
+        declination = asin(sin(radians(ecliptic)) * sin(radians(23.4397)))
+        hour_angle = (sin(radians(-0.833))
+                      - sin(radians(self.latitude)) * sin(declination)) \
+            / (cos(radians(self.latitude)) * cos(declination))
+        if not -1 <= hour_angle <= 1:
+            return None
+        hour_angle = degrees(acos(hour_angle)) / 360
+        return (J2000 + timedelta(days=transit - hour_angle),
+                J2000 + timedelta(days=transit + hour_angle))
+
+    def daylight(self, day, tz):
+        ''' Output: (start, end) of the polling window of a local date,
+                    None if polls aren't paused that day
+        '''
+        sun = self.sun_times(day)
+        if not sun:
+            return None
+        return (sun[0].astimezone(tz) - self.twilight,
+                sun[1].astimezone(tz) + self.twilight)
+
+    def floor(self, time):
+        ''' Output: last interval boundary at or before time '''
+        timestamp = time.timestamp()
+        return datetime.fromtimestamp(timestamp - timestamp % self.interval,
+                                      tz=time.tzinfo)
+
+    def align(self, time):
+        ''' Output: poll time (boundary plus settle delay) at or after time '''
+        boundary = self.floor(time - timedelta(seconds=self.settle))
+        poll = boundary + timedelta(seconds=self.settle)
+        if poll < time:
+            poll += timedelta(seconds=self.interval)
+        return poll
+
+    def next_poll(self, now, budget=None):
+        ''' Input: now (timezone aware), budget requests left today for
+                   polls (per site) or None
+            Output: datetime of the next poll
+        '''
+        poll = self.align(now + timedelta(seconds=1))
+        window = self.daylight(poll.date(), now.tzinfo)
+        if window and poll < window[0]:
+            poll = self.align(window[0])
+        elif window and poll > window[1]:
+            poll = self.__morning(poll.date() + timedelta(days=1), now.tzinfo)
+            window = None
+
+        if budget is None or (window is None and poll.date() != now.date()):
+            return poll
+        elif budget <= 0:
+            # quota is renewed at midnight
+            return self.__morning(now.date() + timedelta(days=1), now.tzinfo)
+
+        # polls left until the evening (or midnight without coordinates)
+        end = window[1] if window else datetime.combine(
+            poll.date() + timedelta(days=1), datetime.min.time(),
+            tzinfo=now.tzinfo)
+        slots = int((end - poll).total_seconds() // self.interval) + 1
+        if slots > budget:
+            poll += timedelta(seconds=self.interval * (ceil(slots / budget)
+                                                       - 1))
+        return poll
+
+    def __morning(self, day, tz):
+        window = self.daylight(day, tz)
+        start = window[0] if window else datetime.combine(
+            day, datetime.min.time(), tzinfo=tz)
+        return self.align(start)
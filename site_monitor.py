@@ -0,0 +1,228 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from .config import SE_API
+from .solaredge_client import solaredge_client
+
+
+class site_monitor(object):
+    ''' Fans requests out over all monitored SolarEdge sites.
+        Every site has its own api client (keep-alive session, cache and
+        daily quota) and, with storage, its own mysql_client writing into
+        the site's table namespace. The unnamed site (name None) uses the
+        plain table names of a single site install.
+    '''
+    def __init__(self, sites, tz=None):
+        ''' Input: [{"name": .., "siteID": .., "apiKey": ..}, ...] '''
+        self.sites = sites
+        self.api = {site["name"]: solaredge_client(site["siteID"],
+                                                   site["apiKey"])
+                    for site in sites}
+        self.storage = {}
+        # seconds spent importing/connecting the storage stack
+        self.storage_timings = {}
+        self.tz = tz
+        if tz:
+            self.set_timezone(tz)
+        # the api allows 3 concurrent requests per source
+        self.pool = ThreadPoolExecutor(
+            max_workers=max(1, min(len(sites), SE_API["concurrency"])))
+
+    def set_timezone(self, timezone):
+        self.tz = timezone
+        for client in self.api.values():
+            client.set_timezone(timezone)
+        for client in self.storage.values():
+            client.set_timezone(timezone)
+
+    def connect_storage(self, language, database, use_ssl):
+        ''' Connects a storage client per site. The storage stack
+            (SQLAlchemy, numpy) is only imported here, on first use.
+
+            Output: {site: 0 or error message}
+        '''
+        start = perf_counter()
+        from .mysql_client import mysql_client
+        self.storage_timings["import"] = perf_counter() - start
+
+        start = perf_counter()
+        for client in self.storage.values():
+            client.close()
+        results = {}
+        for site in self.sites:
+            client = mysql_client(language=language,
+                                  api=self.api[site["name"]],
+                                  site=site["name"])
+            client.set_timezone(self.tz)
+            results[site["name"]] = client.create_connection(database,
+                                                             use_ssl)
+            self.storage[site["name"]] = client
+        self.storage_timings["connect"] = perf_counter() - start
+        return results
+
+    def requests_left(self):
+        ''' Output: requests left today for background calls
+                    (daily quota without the reserve) of the tightest site
+        '''
+        return min(client.budget.remaining - client.budget.reserve
+                   for client in self.api.values())
+
+    def fan_out(self, method, *args, **kwargs):
+        ''' Calls method(site, *args, **kwargs) for every site concurrently.
+
+            Output: {site: result or raised exception}
+        '''
+        futures = {site["name"]: self.pool.submit(method, site["name"],
+                                                  *args, **kwargs)
+                   for site in self.sites}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+        return results
+
+    def current_power(self, json_code):
+        ''' Current power in W summed over all sites.
+            Production (PV) of sites sharing an api key is read from the
+            bulk overview api, one request per key. Single sites (and
+            groups whose bulk request fails), LOAD and GRID are read from
+            every site's currentPowerFlow.
+        '''
+        names = [site["name"] for site in self.sites]
+        total = 0
+        if json_code == "PV":
+            groups = {}
+            for site in self.sites:
+                groups.setdefault(site["apiKey"], []).append(site)
+            for sites in groups.values():
+                if len(sites) < 2:
+                    continue
+                client = self.api[sites[0]["name"]]
+                json_resp = client.get_api_response(
+                    "overview", sites=[site["siteID"] for site in sites])
+                if isinstance(json_resp, int):
+                    # eg. no account level key
+                    continue
+                for item in json_resp["sitesOverviews"]["siteEnergyList"]:
+                    total += item["siteOverview"]["currentPower"]["power"]
+                for site in sites:
+                    names.remove(site["name"])
+
+        def site_power(name):
+            json_resp = self.api[name].get_api_response("currentPowerFlow")
+            flow = json_resp["siteCurrentPowerFlow"]
+            value = flow.get(json_code, {}).get("currentPower", 0)
+            # if they sent kW
+            return value * 1000 if flow["unit"] == "kW" else value
+
+        futures = [self.pool.submit(site_power, name) for name in names]
+        return total + sum(future.result() for future in futures)
+
+    def period_values(self, api, meter, timeUnit, startTime, endTime,
+                      use_storage=False):
+        ''' Values of one meter per period summed over all sites.
+            With storage the derivative tables answer what they cover,
+            only the gaps are requested from the api.
+
+            Output: [{"date": .., "value": ..}] sorted by date
+        '''
+        def site_values(name):
+            plan = None
+            if use_storage and name in self.storage:
+                plan = self.storage[name].plan_period_query(api, meter,
+                                                            timeUnit,
+                                                            startTime,
+                                                            endTime)
+            values, gaps = plan if plan else ([], [(startTime, endTime)])
+            for gapStart, gapEnd in gaps:
+                json_resp = self.api[name].get_api_response(
+                    api, meters=meter.upper(), timeUnit=timeUnit,
+                    startTime=gapStart, endTime=gapEnd)
+                # list of time/value dicts
+                values.extend(json_resp[api]["meters"][0]["values"])
+            return values
+
+        merged = {}
+        for name, values in self.fan_out(site_values).items():
+            if isinstance(values, Exception):
+                raise values
+            for item in values:
+                total = merged.setdefault(item["date"], {"date": item["date"]})
+                if "value" in item:
+                    total["value"] = total.get("value", 0) + item["value"]
+        return [merged[date] for date in sorted(merged)]
+
+    def recent_value(self, meter, startTime, endTime, basetable="energy"):
+        ''' Sum of a meter over a recent window (eg. "today so far")
+            summed over all sites, answered from the in-memory samples.
+
+            Output: value or None if a site doesn't hold the window
+        '''
+        total = 0
+        for client in self.storage.values():
+            sums = client.recent_sum(basetable, startTime, endTime)
+            if sums is None:
+                return None
+            total += sums[meter]
+        return total if self.storage else None
+
+    def archive_values(self, meter, periods, basetable="energy"):
+        ''' Sums of a meter over several (long ago) periods summed over
+            all sites, read from the memory-mapped archives.
+
+            Input: periods [(startTime, endTime)] as datetime
+            Output: [value, ...] or None if a site has no archive
+        '''
+        totals = [0] * len(periods)
+        for client in self.storage.values():
+            sums = client.archive_sums(basetable, meter, periods)
+            if sums is None:
+                return None
+            totals = [total + value for total, value in zip(totals, sums)]
+        return totals if self.storage else None
+
+    def period_totals(self, meter, periods, basetable="energy"):
+        ''' Totals of a meter per date range summed over all sites,
+            resolved from the cumulative index (two lookups a range).
+
+            Input: periods [(startTime, endTime)] as datetime, days included
+            Output: [value, ...] or None if a site doesn't store every day
+        '''
+        totals = [0] * len(periods)
+        for client in self.storage.values():
+            sums = client.period_totals(basetable, periods)
+            if sums is None or None in sums:
+                return None
+            totals = [total + item[meter] for total, item in zip(totals, sums)]
+        return totals if self.storage else None
+
+    def poll(self, since, endTime, **params):
+        ''' Stores new data of every site.
+
+            Input: since {site: startTime}, endTime as "%Y-%m-%d %H:%M:%S",
+                   ingest params
+            Output: {site: rows written or raised exception}
+        '''
+        def site_poll(name):
+            return self.storage[name].ingest(startTime=since[name],
+                                             endTime=endTime, **params)
+
+        return self.fan_out(site_poll)
+
+    def repair_gaps(self):
+        ''' Output: {site: repair report or raised exception} '''
+        return self.fan_out(lambda name: self.storage[name].repair_gaps())
+
+    def apply_retention(self):
+        ''' Output: {site: retention report or raised exception} '''
+        return self.fan_out(
+            lambda name: self.storage[name].apply_retention())
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        for client in self.api.values():
+            client.close()
+        for client in self.storage.values():
+            client.close()
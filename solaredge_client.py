@@ -0,0 +1,234 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import ijson
+except ImportError:
+    # optional, responses are parsed as a whole without it
+    ijson = None
+
+from datetime import datetime, timezone
+from threading import Lock, Thread
+from time import monotonic
+
+from .config import \
+    SE_CREDENTIALS, \
+    SE_API, \
+    SE_API_CACHE_TTL
+from .metrics import registry as metrics, timed
+
+
+class QuotaExceeded(Exception):
+    ''' Raised if a request is deferred to protect the daily API quota '''
+
+
+class ApiError(Exception):
+    ''' Raised if the api answers a required request with an error '''
+
+
+class request_budget(object):
+    ''' Local tracker of the daily SolarEdge request quota.
+        Low priority calls (eg. backfill) are deferred once only the
+        reserve is left, so interactive calls still get answered.
+    '''
+    def __init__(self, limit, reserve, tz=timezone.utc):
+        self.limit = limit
+        self.reserve = reserve
+        self.tz = tz
+        self.used = 0
+        self.day = datetime.now(tz=self.tz).date()
+        self._lock = Lock()
+
+    @property
+    def remaining(self):
+        with self._lock:
+            self.__rollover()
+            return self.limit - self.used
+
+    def acquire(self, priority="high"):
+        ''' Books one request.
+
+            Input: priority "high" or "low"
+            Output: True if the request may be sent
+        '''
+        with self._lock:
+            self.__rollover()
+            left = self.limit - self.used
+            if left <= 0 or (priority == "low" and left <= self.reserve):
+                return False
+            self.used += 1
+            return True
+
+    def book(self, count):
+        ''' Books requests that were sent in addition (eg. retries) '''
+        with self._lock:
+            self.__rollover()
+            self.used += count
+
+    def __rollover(self):
+        today = datetime.now(tz=self.tz).date()
+        if today != self.day:
+            self.day = today
+            self.used = 0
+
+
+class solaredge_client(object):
+    ''' Client for the SolarEdge monitoring API.
+        Keeps one keep-alive session, retries 429/5xx with backoff
+        and tracks the daily request quota. Responses of the apis listed
+        in SE_API_CACHE_TTL are cached and refreshed in the background
+        once they turn stale.
+    '''
+    def __init__(self, siteID=None, apiKey=None, url=None):
+        self.siteID = str(siteID or SE_CREDENTIALS["siteID"])
+        self.apiKey = apiKey or SE_CREDENTIALS["apiKey"]
+        self.url = (url or SE_API["url"]).rstrip("/")
+        self.timeout = SE_API["timeout"]
+        self.budget = request_budget(SE_API["daily_quota"],
+                                     SE_API["reserve"])
+        # {(api, params): (timestamp, json_data)}
+        self.cache = {}
+        self.cache_stats = {"hits": 0, "stale": 0, "misses": 0}
+        self._refreshing = set()
+        self._cache_lock = Lock()
+
+        retry = Retry(total=SE_API["retries"],
+                      backoff_factor=SE_API["backoff"],
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET"]),
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+        self.session.mount("http://", HTTPAdapter(max_retries=retry))
+
+    def set_timezone(self, timezone):
+        self.budget.tz = timezone
+
+    @timed("get_api_response")
+    def get_api_response(self, api, priority="high", sites=None, **kwargs):
+        ''' Requests a site api (served from cache if configured).
+            With sites the bulk api of these siteIDs (same account) is used.
+
+            Input: api name, priority ("high" or "low"), siteIDs, api params
+            Output: json data or http status code on failure
+        '''
+        # kick None args
+        params = {key: value for key, value in kwargs.items()
+                  if value is not None}
+        if sites:
+            path = "sites/{}/{}".format(','.join(str(site) for site in sites),
+                                        api)
+        else:
+            path = "site/{}/{}".format(self.siteID, api)
+        if api not in SE_API_CACHE_TTL:
+            return self.__request(path, priority, params)
+
+        ttl, stale = SE_API_CACHE_TTL[api]
+        key = (path, tuple(sorted(params.items())))
+        with self._cache_lock:
+            cached = self.cache.get(key, None)
+            age = monotonic() - cached[0] if cached else None
+            if cached and age < ttl:
+                self.cache_stats["hits"] += 1
+                metrics.count("solaredge_api_cache_total", api=api,
+                              result="hit")
+                return cached[1]
+            elif cached and age < ttl + stale:
+                # stale-while-revalidate
+                self.cache_stats["stale"] += 1
+                metrics.count("solaredge_api_cache_total", api=api,
+                              result="stale")
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    Thread(target=self.__refresh,
+                           args=(key, path, priority, params),
+                           daemon=True).start()
+                return cached[1]
+            self.cache_stats["misses"] += 1
+            metrics.count("solaredge_api_cache_total", api=api,
+                          result="miss")
+
+        json_data = self.__request(path, priority, params)
+        if isinstance(json_data, dict):
+            with self._cache_lock:
+                self.cache[key] = (monotonic(), json_data)
+        return json_data
+
+    @timed("get_meters")
+    def get_meters(self, api, priority="high", **kwargs):
+        ''' Streams the meters of energyDetails/powerDetails.
+            With ijson installed the response is parsed incrementally,
+            only one meter is held in memory at a time.
+
+            Output: iterator of meter dicts or http status code on failure
+        '''
+        params = {key: value for key, value in kwargs.items()
+                  if value is not None}
+        response = self.__send("site/{}/{}".format(self.siteID, api),
+                               priority, params, stream=True)
+
+        if response.status_code != 200:
+            response.close()
+            return response.status_code
+        elif ijson is None:
+            return iter(response.json()[api]["meters"])
+        return self.__iter_meters(response, api)
+
+    def __iter_meters(self, response, api):
+        with response:
+            response.raw.decode_content = True
+            for meter in ijson.items(response.raw, api + ".meters.item",
+                                     use_float=True):
+                yield meter
+
+    def invalidate_cache(self):
+        with self._cache_lock:
+            self.cache.clear()
+
+    def __refresh(self, key, path, priority, params):
+        try:
+            json_data = self.__request(path, priority, params)
+            if isinstance(json_data, dict):
+                with self._cache_lock:
+                    self.cache[key] = (monotonic(), json_data)
+        except Exception:
+            # the stale entry is kept and expires on its own
+            pass
+        finally:
+            with self._cache_lock:
+                self._refreshing.discard(key)
+
+    def __request(self, path, priority, params):
+        response = self.__send(path, priority, params)
+
+        if response.status_code != 200:
+            return response.status_code
+        return response.json()
+
+    def __send(self, path, priority, params, stream=False):
+        url = "{}/{}".format(self.url, path)
+
+        # api_key= is always sent
+        params = dict(params, api_key=self.apiKey)
+
+        if not self.budget.acquire(priority):
+            raise QuotaExceeded("{} deferred, {} requests left today"
+                                .format(path, self.budget.remaining))
+
+        response = self.session.get(url, params=params, timeout=self.timeout,
+                                    stream=stream)
+        retries = getattr(response.raw, "retries", None)
+        if retries is not None and retries.history:
+            self.budget.book(len(retries.history))
+        if metrics.enabled:
+            sent = 1 + (len(retries.history) if retries is not None else 0)
+            metrics.count("solaredge_api_requests_total", sent,
+                          api=path.rsplit("/", 1)[-1],
+                          status=response.status_code)
+            metrics.gauge("solaredge_api_quota_used", self.budget.used,
+                          site=self.siteID)
+        return response
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,84 @@
+import json
+import os
+import sqlite3
+from datetime import datetime
+from threading import Lock
+
+
+class write_spool(object):
+    ''' Local write-ahead journal for rows the database didn't accept.
+        Every entry is one slice as passed to to_sql. Entries are replayed
+        oldest first and only deleted once written, a replay that is
+        interrupted simply runs again (the writes are upserts).
+        If the journal grows past max_bytes the oldest entries are
+        dropped (see dropped).
+    '''
+    def __init__(self, path, max_bytes):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "api TEXT, checkTime INTEGER, summary TEXT, rows TEXT)")
+        self.pending = self.connection.execute(
+            "SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def append(self, api, rows, checkTime=False, summary=''):
+        ''' Input: api, rows [Time, value, ...], to_sql arguments '''
+        data = json.dumps([[row[0].strftime("%Y-%m-%d %H:%M:%S")
+                            if isinstance(row[0], datetime) else row[0]]
+                           + list(row[1:]) for row in rows])
+        with self._lock:
+            self.connection.execute(
+                "INSERT INTO spool (api, checkTime, summary, rows) "
+                "VALUES (?, ?, ?, ?)", (api, int(checkTime), summary, data))
+            self.pending += 1
+            while self.pending > 1 and self.__used() > self.max_bytes:
+                self.connection.execute(
+                    "DELETE FROM spool WHERE id = "
+                    "(SELECT MIN(id) FROM spool)")
+                self.pending -= 1
+                self.dropped += 1
+
+    def drain(self, write, batch=50):
+        ''' Replays entries oldest first until the journal is empty or
+            write raises (the entry stays for the next drain).
+
+            Input: write(api, rows, checkTime, summary)
+            Output: number of replayed entries
+        '''
+        replayed = 0
+        while True:
+            with self._lock:
+                entries = self.connection.execute(
+                    "SELECT id, api, checkTime, summary, rows FROM spool "
+                    "ORDER BY id LIMIT ?", (batch,)).fetchall()
+            if not entries:
+                return replayed
+            for id, api, checkTime, summary, data in entries:
+                rows = [[datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S")
+                         if isinstance(row[0], str) and len(row[0]) == 19
+                         else row[0]] + row[1:] for row in json.loads(data)]
+                write(api, rows, bool(checkTime), summary)
+                with self._lock:
+                    self.connection.execute("DELETE FROM spool WHERE id = ?",
+                                            (id,))
+                    self.pending -= 1
+                replayed += 1
+
+    def __used(self):
+        page_count, = self.connection.execute("PRAGMA page_count").fetchone()
+        free, = self.connection.execute("PRAGMA freelist_count").fetchone()
+        size, = self.connection.execute("PRAGMA page_size").fetchone()
+        return (page_count - free) * size
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
@@ -0,0 +1,11 @@
+''' Loads the skill modules as package "solaredge_skill" (without the
+    mycroft entry point in __init__.py), see benchmark/skill.py
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "benchmark"))
+from skill import load  # noqa: E402
+
+load()
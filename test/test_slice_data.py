@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from solaredge_skill.columnar import energy_columns, np
+from solaredge_skill.mysql_client import mysql_client
+
+
+def quarter_hours(start, end):
+    rows = []
+    time = start
+    while time < end:
+        rows.append([time, 1.0, 2.0])
+        time += timedelta(minutes=15)
+    return rows
+
+
+def as_columns(rows):
+    return energy_columns(
+        np.array([row[0] for row in rows], dtype="datetime64[s]"),
+        np.array([row[1:] for row in rows], dtype=np.float64))
+
+
+@pytest.fixture(params=["rows", "columns"])
+def chunk(request):
+    ''' Converts a row list into the tested input type '''
+    if request.param == "rows":
+        return lambda rows: rows
+    if np is None:
+        pytest.skip("numpy is not installed")
+    return as_columns
+
+
+@pytest.fixture
+def slicer():
+    return mysql_client("sqlite")._slice_data
+
+
+def first_times(slices):
+    return [list(piece)[0][0] for piece in slices]
+
+
+@pytest.mark.parametrize("slice, start, end, expected", [
+    ("day", datetime(2021, 3, 30, 22), datetime(2021, 4, 1, 2),
+     [datetime(2021, 3, 30, 22), datetime(2021, 3, 31),
+      datetime(2021, 4, 1)]),
+    # 2021-03-29 and 2021-04-05 are mondays
+    ("week", datetime(2021, 3, 28), datetime(2021, 4, 6),
+     [datetime(2021, 3, 28), datetime(2021, 3, 29), datetime(2021, 4, 5)]),
+    ("month", datetime(2021, 1, 31, 23), datetime(2021, 3, 1, 1),
+     [datetime(2021, 1, 31, 23), datetime(2021, 2, 1),
+      datetime(2021, 3, 1)]),
+    ("year", datetime(2020, 12, 31, 23), datetime(2021, 1, 1, 1),
+     [datetime(2020, 12, 31, 23), datetime(2021, 1, 1)]),
+])
+def test_boundaries(slicer, chunk, slice, start, end, expected):
+    rows = quarter_hours(start, end)
+    slices = list(slicer([chunk(rows)], slice))
+    assert first_times(slices) == expected
+    assert sum(len(piece) for piece in slices) == len(rows)
+    assert [row for piece in slices for row in piece] == rows
+
+
+def test_chunk_starting_on_boundary(slicer, chunk):
+    rows = quarter_hours(datetime(2021, 6, 1), datetime(2021, 6, 2, 1))
+    slices = list(slicer([chunk(rows)], "day"))
+    assert first_times(slices) == [datetime(2021, 6, 1),
+                                   datetime(2021, 6, 2)]
+    assert [len(piece) for piece in slices] == [96, 4]
+
+
+def test_single_period_is_not_split(slicer, chunk):
+    rows = quarter_hours(datetime(2021, 6, 1), datetime(2021, 6, 2))
+    slices = list(slicer([chunk(rows)], "month"))
+    assert [len(piece) for piece in slices] == [96]
+
+
+def test_repeated_dst_hour(slicer, chunk):
+    # local times of the end of DST (2021-10-31, Europe): 02:00-02:45 twice
+    rows = quarter_hours(datetime(2021, 10, 30, 23), datetime(2021, 10, 31, 3))
+    repeated = quarter_hours(datetime(2021, 10, 31, 2),
+                             datetime(2021, 10, 31, 3))
+    rows = rows[:-4] + repeated + rows[-4:]
+    slices = list(slicer([chunk(rows)], "day"))
+    assert first_times(slices) == [datetime(2021, 10, 30, 23),
+                                   datetime(2021, 10, 31)]
+    assert [len(piece) for piece in slices] == [4, 12 + 4]
+    assert [row for piece in slices for row in piece] == rows
+
+
+def test_several_chunks_and_empty(slicer, chunk):
+    first = quarter_hours(datetime(2021, 6, 1, 23), datetime(2021, 6, 2, 1))
+    second = quarter_hours(datetime(2021, 6, 2, 1), datetime(2021, 6, 2, 2))
+    slices = list(slicer([chunk(first), chunk(second)], "day"))
+    assert [len(piece) for piece in slices] == [4, 4, 4]
+    assert list(slicer([], "day")) == []
+
+
+def test_upper_case_slice(slicer, chunk):
+    rows = quarter_hours(datetime(2021, 6, 1, 23), datetime(2021, 6, 2, 1))
+    assert len(list(slicer([chunk(rows)], "DAY"))) == 2
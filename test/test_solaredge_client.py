@@ -0,0 +1,91 @@
+from time import perf_counter
+
+import pytest
+
+from solaredge_skill import config
+from solaredge_skill.solaredge_client import solaredge_client, \
+    QuotaExceeded
+from stub_server import stub_server
+
+
+@pytest.fixture
+def stub():
+    server = stub_server().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(stub, monkeypatch):
+    ''' Client of the stub: 2 retries without backoff, quota 10 with a
+        reserve of 5
+    '''
+    monkeypatch.setitem(config.SE_API, "retries", 2)
+    monkeypatch.setitem(config.SE_API, "backoff", 0)
+    monkeypatch.setitem(config.SE_API, "daily_quota", 10)
+    monkeypatch.setitem(config.SE_API, "reserve", 5)
+    api = solaredge_client("1", "key", url=stub.url)
+    yield api
+    api.close()
+
+
+def test_response(stub, client):
+    json_data = client.get_api_response("dataPeriod")
+    assert json_data["dataPeriod"]["startDate"] == stub.data_start
+    assert stub.requests == 1
+    assert client.budget.used == 1
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_retry(stub, client, status):
+    stub.fail(status, times=2)
+    assert "dataPeriod" in client.get_api_response("dataPeriod")
+    assert stub.requests == 3
+    # retries count against the quota
+    assert client.budget.used == 3
+
+
+def test_retries_are_bounded(stub, client):
+    stub.fail(503, times=5)
+    assert client.get_api_response("dataPeriod") == 503
+    assert stub.requests == 3
+
+
+def test_no_retry_on_client_error(stub, client):
+    stub.fail(403)
+    assert client.get_api_response("dataPeriod") == 403
+    assert stub.requests == 1
+
+
+def test_retry_after(stub, client):
+    stub.fail(429, retry_after=1)
+    start = perf_counter()
+    assert "dataPeriod" in client.get_api_response("dataPeriod")
+    assert perf_counter() - start >= 1
+    assert stub.requests == 2
+
+
+def test_status_checked_before_parsing(stub, client):
+    # error pages aren't json
+    stub.fail(403, body=b"<html>Forbidden</html>")
+    assert client.get_api_response("dataPeriod") == 403
+    stub.fail(404, body=b"not json")
+    assert client.get_meters("energyDetails", timeUnit="DAY",
+                             startTime="2021-06-01 00:00:00",
+                             endTime="2021-06-02 00:00:00") == 404
+
+
+def test_quota_defers_low_priority(stub, client):
+    for _ in range(5):
+        client.get_api_response("dataPeriod", priority="low")
+    # only the reserve is left, low priority calls aren't sent
+    with pytest.raises(QuotaExceeded):
+        client.get_api_response("dataPeriod", priority="low")
+    assert stub.requests == 5
+    for _ in range(5):
+        client.get_api_response("dataPeriod")
+    # quota used up
+    with pytest.raises(QuotaExceeded):
+        client.get_api_response("dataPeriod")
+    assert stub.requests == 10
+    assert client.budget.remaining == 0